@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""
+Compare two sets of results written by run.py, for example from before and
+after a change. Exits with status 1 if any operation got slower (or used
+more memory) by more than the threshold.
+"""
+
+import json
+import sys
+from optparse import OptionParser
+
+
+def load(filename):
+    with open(filename) as f:
+        output = json.load(f)
+    results = {}
+    for result in output["results"]:
+        results[(result["case"], result["operation"])] = result
+    return output, results
+
+
+def ratio(old, new):
+    if not old:
+        return None
+    return float(new) / old
+
+
+def parse_args():
+    p = OptionParser(usage='%prog old.json new.json',
+           description='compares two benchmark results')
+    p.add_option('-t', '--threshold', type='float', default=0.1,
+                 help='fractional slow down that counts as a regression '
+                      '(default: 0.1)')
+    options, args = p.parse_args()
+    if len(args) != 2:
+        p.error('expecting two result files')
+    return options.threshold, args
+
+
+def main():
+    threshold, (old_file, new_file) = parse_args()
+    old_output, old = load(old_file)
+    new_output, new = load(new_file)
+    print "old: %s (%s)" % (old_output["revision"], old_output["time"])
+    print "new: %s (%s)" % (new_output["revision"], new_output["time"])
+    print "%-20s %-22s %12s %12s %7s %9s" % ("case", "operation", "old",
+                                             "new", "time", "memory")
+
+    regressions = 0
+    for key in sorted(set(old) & set(new)):
+        time_ratio = ratio(old[key]["best"], new[key]["best"])
+        mem_ratio = ratio(old[key].get("peak_rss_kb"),
+                          new[key].get("peak_rss_kb"))
+        flag = ""
+        for r in (time_ratio, mem_ratio):
+            if r is not None and r > 1 + threshold:
+                flag = "  <-- regression"
+        if flag:
+            regressions += 1
+        print "%-20s %-22s %11.6fs %11.6fs %6.2fx %8sx%s" % \
+            (key[0], key[1], old[key]["best"], new[key]["best"], time_ratio,
+             "-" if mem_ratio is None else "%.2f" % mem_ratio, flag)
+
+    for key in sorted(set(old) ^ set(new)):
+        print "%-20s %-22s only in %s" % \
+            (key[0], key[1], "old" if key in old else "new")
+
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
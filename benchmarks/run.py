@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+"""
+Benchmark pexif parsing, dumping and writing.
+
+Each case is a synthetic JPEG (see synthetic.py), or a directory of real
+JPEG files given with --corpus. For every case and operation the best and
+mean time per operation and the peak memory used are recorded. Results are
+written as JSON, which compare.py can compare between two runs.
+
+Peak memory is the increase in maximum resident set size of a child
+process which sets up and runs the operation once, so it includes the
+parse needed by operations such as dump.
+"""
+
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+import pexif
+import synthetic
+
+# name: (image_size, entries, endian, maker)
+CASES = [
+    ("small", (64 * 1024, 20, "<", None)),
+    ("big-endian", (64 * 1024, 20, ">", None)),
+    ("canon", (1024 * 1024, 100, "<", "canon")),
+    ("fuji", (1024 * 1024, 100, "<", "fuji")),
+    ("many-entries", (256 * 1024, 1000, "<", None)),
+    ("large-image", (16 * 1024 * 1024, 50, "<", None)),
+    ]
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def parsed(path):
+    return pexif.JpegFile.fromFile(path)
+
+
+def geo_set(path):
+    jf = parsed(path)
+    jf.set_geo(51.522, -1.455)
+    return jf
+
+
+def set_geo_and_write(data):
+    # A fresh parse each time, so the write always has a change to encode
+    jf = pexif.JpegFile.fromString(data)
+    jf.set_geo(51.522, -1.455)
+    return jf.writeString()
+
+# name: (setup, run). setup is given a path and returns the argument for run.
+OPERATIONS = [
+    ("fromFile", (lambda path: path,
+                  lambda path: pexif.JpegFile.fromFile(path))),
+    ("fromFile-headers-only", (lambda path: path,
+                               lambda path: pexif.JpegFile.fromFile(
+                                   path, mode="ro", headers_only=True,
+                                   lazy=True))),
+    ("fromString", (read, pexif.JpegFile.fromString)),
+    ("get_exif", (parsed, lambda jf: jf.get_exif())),
+    ("dump", (parsed, lambda jf: jf.dump(StringIO.StringIO()))),
+    # Unmodified segments are written from the bytes they were read from
+    ("writeString-unmodified", (parsed, lambda jf: jf.writeString())),
+    # Modified EXIF data goes through the serializer on every write
+    ("writeString-modified", (geo_set, lambda jf: jf.writeString())),
+    ("set_geo-writeString", (read, set_geo_and_write)),
+    ("set_geo", (parsed, lambda jf: jf.set_geo(51.522, -1.455))),
+    ]
+
+
+def time_operation(paths, setup, run, repeat, min_time):
+    """Return (number, best, mean) where best and mean are the time in
+    seconds to run the operation once on every file in paths."""
+    args = [setup(path) for path in paths]
+
+    def run_all():
+        for arg in args:
+            run(arg)
+
+    number = 1
+    while True:
+        elapsed = timeit.timeit(run_all, number=number)
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number *= 2
+    times = [elapsed] + timeit.repeat(run_all, number=number,
+                                      repeat=repeat - 1)
+    times = [t / number for t in times]
+    return number, min(times), sum(times) / len(times)
+
+
+def _peak_memory_child(paths, op_index, conn):
+    setup, run = OPERATIONS[op_index][1]
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for path in paths:
+        run(setup(path))
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    conn.send(after - before)
+    conn.close()
+
+
+def peak_memory(paths, op_index):
+    """Return the peak memory increase, in KB, of setting up and running
+    an operation once on every file in paths in a child process."""
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_peak_memory_child,
+                                      args=(paths, op_index, child))
+    process.start()
+    result = parent.recv()
+    process.join()
+    if sys.platform == "darwin":
+        # ru_maxrss is in bytes rather than KB
+        result /= 1024
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       stderr=open(os.devnull, "w"),
+                                       cwd=os.path.dirname(
+                                           os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    p = OptionParser(usage='%prog [options]',
+           description='benchmarks pexif and writes the results as JSON')
+    p.add_option('-o', '--output', default=None,
+                 help='file to write results to (default: stdout)')
+    p.add_option('-c', '--corpus', action='append', default=[],
+                 help='directory of JPEG files to benchmark as one case')
+    p.add_option('-k', '--case', action='append', default=[],
+                 help='only run the named synthetic case (may be repeated)')
+    p.add_option('-r', '--repeat', type='int', default=5,
+                 help='number of timed repeats (default: 5)')
+    p.add_option('-t', '--min-time', type='float', default=0.2,
+                 help='minimum seconds per timed repeat (default: 0.2)')
+    p.add_option('--no-memory', action='store_true', default=False,
+                 help='don\'t measure peak memory')
+    options, args = p.parse_args()
+    if args:
+        p.error('unexpected arguments')
+    return options
+
+
+def main():
+    options = parse_args()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cases = []
+        for name, args in CASES:
+            if options.case and name not in options.case:
+                continue
+            path = os.path.join(tmpdir, name + ".jpg")
+            with open(path, "wb") as f:
+                f.write(synthetic.make_jpeg(*args))
+            cases.append((name, [path]))
+        for corpus in options.corpus:
+            paths = sorted(glob.glob(os.path.join(corpus, "*.jpg")) +
+                           glob.glob(os.path.join(corpus, "*.JPG")))
+            cases.append(("corpus:" + corpus, paths))
+
+        results = []
+        for name, paths in cases:
+            for op_index, (op, (setup, run)) in enumerate(OPERATIONS):
+                number, best, mean = time_operation(paths, setup, run,
+                                                    options.repeat,
+                                                    options.min_time)
+                result = {"case": name, "operation": op, "files": len(paths),
+                          "bytes": sum(os.path.getsize(p) for p in paths),
+                          "number": number, "best": best, "mean": mean}
+                if not options.no_memory:
+                    result["peak_rss_kb"] = peak_memory(paths, op_index)
+                results.append(result)
+                print >> sys.stderr, "%-20s %-22s %10.6fs" % (name, op, best)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    output = {"revision": git_revision(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "results": results}
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""
+Generate synthetic JPEG files for benchmarking pexif.
+
+The files have a real EXIF segment, built using pexif itself, with a
+controlled number of entries, byte order and maker note. The image data is
+filler of a given size, so the files can be parsed but not displayed.
+"""
+
+import random
+import pexif
+from pexif import SHORT, LONG, RATIONAL, ASCII, Rational
+from struct import pack
+
+SOI = pexif.SOI_MARKER
+EOI = pexif.EOI_MARKER
+
+# Tags in the private range, used for the generated entries
+FIRST_TAG = 0xc000
+
+MAKERS = {
+    None: ("Pexif", None),
+    "canon": ("Canon", pexif.CanonIFD),
+    "fuji": ("FUJIFILM", pexif.FujiIFD),
+    }
+
+
+def segment(marker, data):
+    """Return a JPEG segment with the given marker and data."""
+    return "\xff" + chr(marker) + pack(">H", len(data) + 2) + data
+
+
+def image_data(size, seed=0):
+    """Return size bytes of filler for the image data. 0xff never appears,
+    so the filler can't be mistaken for a marker."""
+    rng = random.Random(seed)
+    block = "".join(chr(rng.randint(0, 0xfe)) for i in range(4096))
+    return (block * (size / len(block) + 1))[:size]
+
+
+def entry_value(i):
+    """Return the (type, value) of the i-th generated entry. The entries
+    cycle through small and large values of the common types."""
+    kind = i % 6
+    if kind == 0:
+        return SHORT, [i & 0xffff]
+    elif kind == 1:
+        return LONG, [i * 1000]
+    elif kind == 2:
+        return RATIONAL, [Rational(i, 100)]
+    elif kind == 3:
+        return ASCII, "entry %d\0" % i
+    elif kind == 4:
+        return SHORT, [(i + j) & 0xffff for j in range(16)]
+    else:
+        return RATIONAL, [Rational(i, 1), Rational(i % 60, 1), Rational(i, 100)]
+
+
+def add_entries(ifd, count, first_tag=FIRST_TAG):
+    for i in range(count):
+        exif_type, value = entry_value(i)
+        ifd.append_entry((first_tag + i, exif_type,
+                          pexif.stored_value(exif_type, value)))
+
+
+def make_jpeg(image_size=1024 * 1024, entries=50, endian="<", maker=None):
+    """Return the data of a synthetic JPEG file with image_size bytes of
+    image data and about entries EXIF entries, split between the primary
+    and Extended EXIF IFDs. endian is "<" or ">". maker is None, "canon"
+    or "fuji", and adds a maker note with a tenth of the entries. Maker
+    notes are always little endian, so need endian to be "<"."""
+    if maker is not None and endian != "<":
+        raise ValueError("Maker notes are only supported for little endian")
+    make, maker_class = MAKERS[maker]
+
+    data = SOI
+    data += segment(0xdb, "\0" * 65)
+    data += segment(0xc0, "\x08\x00\x10\x00\x10\x01\x01\x11\x00")
+    data += segment(0xda, "\x01\x01\x00\x00\x3f\x00")
+    data += image_data(image_size)
+    data += EOI
+    jf = pexif.JpegFile.fromString(data)
+
+    exif = jf.get_exif(create=True)
+    exif.e = endian
+    exif.tiff_endian = "II" if endian == "<" else "MM"
+    primary = exif.get_primary(create=True)
+    primary.Make = make
+    primary.Model = "Synthetic"
+    primary.DateTime = "2010:01:01 12:00:00"
+    extended = primary.ExtendedEXIF
+    extended.DateTimeOriginal = "2010:01:01 12:00:00"
+    add_entries(primary, entries / 2)
+    add_entries(extended, entries - entries / 2)
+    if maker_class is not None:
+        note = maker_class("<", 0, exif, "rw")
+        add_entries(note, max(1, entries / 10), first_tag=0x2000)
+        extended.MakerNote = note
+    jf.set_geo(-33.8568, 151.2153)
+    return jf.writeString()
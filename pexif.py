@@ -91,20 +91,46 @@ try:
 except AttributeError:
  print "No Focal Length data"
 
+Tag values are returned as lists (or strings for text tags). Changing a
+list changes the tag, e.g.:
+
+img.exif.primary.GPS.GPSLatitude[2] = pexif.Rational(30, 1)
+
+but changing a Rational within it in place (e.g. its num) doesn't; assign
+a new Rational instead.
+
+This module parses and writes single files. The pexif_batch module
+processes many files in parallel, and pexif_index keeps an SQLite index
+of the tags of a tree of files; both use only the public API of this
+module.
+
 """
 
 import StringIO
+import collections
+from array import array
+import mmap
+import os
+import re
+import shutil
 import sys
-from struct import unpack, pack
+import tempfile
+import threading
+import timeit
+from struct import Struct, unpack, unpack_from, pack, pack_into
+from struct import error as StructError
 
 MAX_HEADER_SIZE = 64 * 1024
+COPY_CHUNK_SIZE = 64 * 1024
 DELIM = 0xff
 EOI = 0xd9
+SOS = 0xda
 SOI_MARKER = chr(DELIM) + '\xd8'
 EOI_MARKER = chr(DELIM) + '\xd9'
 
 TIFF_OFFSET = 6
 TIFF_TAG = 0x2a
+EXIF_OFFSET = 0x8769
 
 DEBUG = 0
 
@@ -116,6 +142,14 @@ DEBUG = 0
 # be raised.
 unknown_maker_note_as_error = False
 
+# Set `metadata_cache` to a MetadataCache to have files opened with
+# JpegFile.fromFile in "ro" mode served from the cache.
+metadata_cache = None
+
+# Set `profiler` to a Profiler to record the time spent in, and bytes
+# processed by, each stage of reading and writing files.
+profiler = None
+
 
 def debug(*debug_string):
     """Used for print style debugging. Enable by setting the global
@@ -126,7 +160,192 @@ def debug(*debug_string):
         print
 
 
-class DefaultSegment:
+class Profiler(object):
+    """Counts the calls, time and bytes processed by each stage of reading
+    and writing files in this process. Enable it by setting the module
+    global profiler to an instance; any object with the same clock and
+    record methods may be used instead.
+
+    The stages are "scan" (JpegFile reading the segments of a file, with
+    the bytes read), "segment.<class>" (constructing a segment, with the
+    size of its data), "ifd.<class>" (decoding an IFD, with the size of
+    its entry table), "serialize" (building modified EXIF data) and
+    "write" (JpegFile.writeFd). The time of a stage includes the stages
+    nested within it, such as the IFDs embedded in an IFD.
+
+    labels is a dictionary of labels added to every exported counter, for
+    example to tell apart the profiles of different sets of files."""
+
+    clock = staticmethod(timeit.default_timer)
+
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        # Maps stage names to [calls, seconds, bytes]
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, start, nbytes=0):
+        """Record a call of stage which started at clock() time start and
+        processed nbytes bytes."""
+        elapsed = self.clock() - start
+        with self.lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = [0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] += nbytes
+
+    def reset(self):
+        """Discard all the counts recorded so far."""
+        with self.lock:
+            self.stages.clear()
+
+    def prometheus(self, prefix="pexif"):
+        """Return the counters in the Prometheus text exposition format."""
+        metrics = [("stage_calls_total", "Number of calls of each stage.", 0),
+                   ("stage_seconds_total", "Seconds spent in each stage.", 1),
+                   ("stage_bytes_total", "Bytes processed by each stage.", 2)]
+        with self.lock:
+            stages = sorted((stage, list(stats))
+                            for stage, stats in self.stages.items())
+        lines = []
+        for suffix, help, index in metrics:
+            name = "%s_%s" % (prefix, suffix)
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s counter" % name)
+            for stage, stats in stages:
+                labels = dict(self.labels, stage=stage)
+                labels = ",".join('%s="%s"' % (key, _prometheus_escape(value))
+                                  for key, value in sorted(labels.items()))
+                lines.append("%s{%s} %r" % (name, labels, stats[index]))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, filename, prefix="pexif"):
+        """Write the counters, as for prometheus, to the file named
+        filename, replacing it atomically so that a collector reading
+        the file never sees it half written. The file is readable by
+        everyone, as collectors often run as another user."""
+        dirname = os.path.dirname(os.path.abspath(filename))
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as output:
+                output.write(self.prometheus(prefix))
+                # mkstemp creates the file readable only by its owner
+                os.fchmod(fd, 0644)
+            os.rename(tmp_path, filename)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+
+def _prometheus_escape(value):
+    """Escape value for use as a Prometheus label value."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+_structs = {}
+
+# The largest IFD entry table whose Struct is cached by ifd_entries
+MAX_CACHED_ENTRIES = 128
+
+
+def get_struct(fmt):
+    """Return a struct.Struct for the format fmt, which is compiled only
+    the first time it's used."""
+    compiled = _structs.get(fmt)
+    if compiled is None:
+        compiled = _structs[fmt] = Struct(fmt)
+    return compiled
+
+
+def ifd_entries(data, e, offset):
+    """Return a list of (tag, exif_type, components, value) tuples, one
+    for each entry in the table of the IFD at offset in data. A count
+    which doesn't fit in data raises InvalidFile before any entries are
+    decoded. The whole table is decoded with one call. Its Struct is only
+    cached for tables of up to MAX_CACHED_ENTRIES entries, so corrupt
+    counts can't fill the cache."""
+    num_entries = get_struct(e + "H").unpack_from(data, offset)[0]
+    if offset + 2 + 12 * num_entries > len(data):
+        raise JpegFile.InvalidFile("IFD at offset %d has more entries (%d) "
+                                   "than fit in the EXIF data." %
+                                   (offset, num_entries))
+    fmt = e + "HHII" * num_entries
+    if num_entries <= MAX_CACHED_ENTRIES:
+        table = get_struct(fmt)
+    else:
+        table = Struct(fmt)
+    values = table.unpack_from(data, offset + 2)
+    # Group the values into one tuple of four per entry
+    return zip(*[iter(values)] * 4)
+
+
+def data_slice(data, start, length):
+    """Return length bytes of data (a string or buffer) from start.
+    Slicing a buffer would copy the data, so for buffers this returns a
+    new buffer sharing the same memory instead."""
+    if isinstance(data, buffer):
+        return buffer(data, start, length)
+    return data[start:start + length]
+
+
+def _tell(fd):
+    """Return the position of the file object fd, or None if it doesn't
+    have one, such as for a pipe."""
+    try:
+        return fd.tell()
+    except (IOError, AttributeError):
+        return None
+
+
+class MappedFile:
+    """A read-only file object over a memory mapped file. Unlike a normal
+    file read returns buffers which refer directly to the mapped memory,
+    rather than copies of the data."""
+
+    def __init__(self, map):
+        self.map = map
+        self.pos = 0
+
+    def read(self, size=-1):
+        """Return a buffer of up to size bytes from the current position."""
+        if size < 0:
+            size = len(self.map) - self.pos
+        size = max(0, min(size, len(self.map) - self.pos))
+        data = buffer(self.map, self.pos, size)
+        self.pos += size
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self.map)
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+
+def copy_range(src, dst, offset, length):
+    """Copy length bytes starting at offset in the file object src
+    to the current position of the file object dst. The data is copied
+    in chunks through a single buffer, so memory use doesn't depend on
+    length."""
+    src.seek(offset)
+    buf = bytearray(min(length, COPY_CHUNK_SIZE))
+    view = memoryview(buf)
+    while length:
+        n = src.readinto(view[:min(length, len(buf))])
+        if not n:
+            raise JpegFile.InvalidFile("Unexpected end of file.")
+        dst.write(view[:n])
+        length -= n
+
+
+class DefaultSegment(object):
     """DefaultSegment represents a particluar segment of a JPEG file.
     This class is instantiated by JpegFile when parsing Jpeg files
     and is not intended to be used directly by the programmer. This
@@ -135,6 +354,8 @@ class DefaultSegment:
     extra information about a particular segment.
     """
 
+    __slots__ = ('marker', 'data', 'mode', 'fd', 'code', 'data_offset')
+
     def __init__(self, marker, fd, data, mode):
         """The constructor for DefaultSegment takes the marker which
         identifies the segments, a file object which is currently positioned
@@ -144,6 +365,8 @@ class DefaultSegment:
         self.marker = marker
         self.data = data
         self.mode = mode
+        # Offset of data in the file it was read from, set by JpegFile
+        self.data_offset = None
         self.fd = fd
         self.code = jpeg_markers.get(self.marker, ('Unknown-{}'.format(self.marker), None))[0]
         assert mode in ["rw", "ro"]
@@ -184,65 +407,345 @@ class DefaultSegment:
             (jpeg_markers[self.marker][0], len(self.data))
 
 
+# Markers which may appear within entropy coded image data, and which
+# aren't followed by a length: 0x00 (byte stuffing), TEM and RST0-RST7.
+STANDALONE_MARKERS = frozenset([0x00, 0x01] + range(0xd0, 0xd8))
+
+# Matches a marker which isn't a standalone marker or a fill byte
+SEGMENT_MARKER_RE = re.compile(r'\xff[^\x00\x01\xd0-\xd7\xff]')
+
+
+def find_eoi(data, pos=0):
+    """Return the offset of the EOI marker which ends the image data
+    starting at pos in data (a string or mmap), or -1 if there isn't one.
+    Only 0xff bytes are examined, so this runs at the speed of data.find.
+    Byte stuffing, RST markers and fill bytes are stepped over, as are
+    any segments between the scans of a progressive image."""
+    end = len(data)
+    while 1:
+        pos = data.find('\xff', pos)
+        if pos < 0 or pos + 1 >= end:
+            return -1
+        mark = ord(data[pos + 1])
+        if mark == EOI:
+            return pos
+        if mark == DELIM:
+            # Fill byte
+            pos += 1
+        elif mark in STANDALONE_MARKERS:
+            pos += 2
+        elif pos + 4 <= end:
+            pos += 2 + unpack_from(">H", data, pos + 2)[0]
+        else:
+            return -1
+
+
+def find_last_eoi(fd, offset):
+    """Return the offset, relative to offset, of the last EOI marker after
+    offset in the file object fd, or -1 if there isn't one. The file is
+    read backwards a chunk at a time, so usually only the last chunk is
+    read."""
+    fd.seek(0, 2)
+    end = fd.tell()
+    # The first byte of the chunk after this one, which may complete a
+    # marker
+    next_byte = ''
+    while end > offset:
+        start = max(offset, end - COPY_CHUNK_SIZE)
+        fd.seek(start)
+        chunk = str(fd.read(end - start))
+        pos = (chunk + next_byte).rfind(EOI_MARKER)
+        if pos >= 0:
+            return start + pos - offset
+        next_byte = chunk[:1]
+        end = start
+    return -1
+
+
+def index_scans(fd, offset, eoi_optional=False):
+    """Walk the image data starting at offset in the file object fd,
+    reading it a chunk at a time. Returns (length, scans) where length
+    is the length of the image data up to the EOI marker and scans is a
+    list of (offset, length) pairs, one for the entropy coded data of
+    each scan. Markers are found with SEGMENT_MARKER_RE, so the entropy
+    coded data is searched at the speed of the re module, and segments
+    between scans are skipped over without being read. If eoi_optional
+    is true, the end of fd is also taken as the end of the image data."""
+    scans = []
+    start = offset
+    fd.seek(offset)
+    base = offset
+    buf = ''
+    pos = 0
+    while 1:
+        match = SEGMENT_MARKER_RE.search(buf, pos)
+        if match is not None:
+            pos = match.start()
+        elif buf.endswith('\xff'):
+            # Keep the last byte, it may be the start of a marker
+            pos = len(buf) - 1
+        else:
+            pos = len(buf)
+        if pos + 4 > len(buf):
+            chunk = str(fd.read(COPY_CHUNK_SIZE))
+            if chunk:
+                base += pos
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            if match is not None:
+                mark = ord(buf[pos + 1])
+            elif eoi_optional:
+                pos = len(buf)
+                mark = EOI
+            else:
+                raise JpegFile.InvalidFile("Unable to find EOI marker.")
+        else:
+            mark = ord(buf[pos + 1])
+        if mark == EOI:
+            if start is not None:
+                scans.append((start, base + pos - start))
+            return base + pos - offset, scans
+        if pos + 4 > len(buf):
+            raise JpegFile.InvalidFile("Unable to find EOI marker.")
+        if start is not None:
+            scans.append((start, base + pos - start))
+            start = None
+        pos += 2 + unpack_from(">H", buf, pos + 2)[0]
+        if mark == SOS:
+            start = base + pos
+        if pos > len(buf):
+            base += pos
+            buf = ''
+            pos = 0
+            fd.seek(base)
+
+
 class StartOfScanSegment(DefaultSegment):
     """The StartOfScan segment needs to be treated specially as the actual
     image data directly follows this segment, and that data is not included
     in the size as reported in the segment header. This instances of this class
     are created by JpegFile and it should not be subclassed.
     """
-    def __init__(self, marker, fd, data, mode):
-        DefaultSegment.__init__(self, marker, fd, data, mode)
-        # For SOS we also pull out the actual data
-        img_data = fd.read()
 
-        # Usually the EOI marker will be at the end of the file,
-        # optimise for this case
-        if img_data[-2:] == EOI_MARKER:
-            remaining = 2
+    __slots__ = ('img_offset', '_img_length', 'img_data', 'scans',
+                 'end_finder')
+
+    def __init__(self, marker, fd, data, mode, headers_only=False):
+        """As well as the usual segment arguments, headers_only may be
+        set to avoid reading the image data. In this case only the
+        offset of the image data within fd is recorded and img_data is
+        None. Its length is found when first needed, by calling
+        end_finder (see JpegFile._find_end), or by find_end. fd may be
+        None (with headers_only) when the image data isn't available, in
+        which case img_offset and img_length are left for the caller to
+        fill in."""
+        DefaultSegment.__init__(self, marker, fd, data, mode)
+        self.img_data = None
+        self.scans = None
+        self.end_finder = None
+        self._img_length = None
+        if fd is None:
+            self.img_offset = None
+            return
+        self.img_offset = fd.tell()
+
+        if not headers_only:
+            # For SOS we also pull out the actual data
+            img_data = fd.read()
+            self._img_length = self._scan_length(fd, img_data)
+            self.img_data = data_slice(img_data, 0, self._img_length)
+            fd.seek(self.img_offset + self._img_length)
+
+    def _get_img_length(self):
+        if self._img_length is None and self.end_finder is not None:
+            self.end_finder()
+        return self._img_length
+
+    def _set_img_length(self, img_length):
+        self._img_length = img_length
+
+    img_length = property(_get_img_length, _set_img_length)
+
+    def find_end(self, fd):
+        """Find the length and the scans of the image data, which weren't
+        read (headers_only), in fd, the file object the segment was read
+        from. The image data is scanned for the EOI marker a chunk at a
+        time, but not kept. An EOI marker at the end of the file can't be
+        trusted, as images with trailers such as MPF files end with the
+        EOI marker of the last image, so the last EOI marker is only used
+        if the image data isn't well formed."""
+        try:
+            self._img_length, self.scans = index_scans(fd, self.img_offset)
+        except JpegFile.InvalidFile:
+            length = find_last_eoi(fd, self.img_offset)
+            if length < 0:
+                raise JpegFile.InvalidFile("Unable to find EOI marker.")
+            self._img_length = length
+
+    def _scan_length(self, fd, img_data):
+        """Return the length of the image data at the start of img_data,
+        which was read from fd at img_offset."""
+        if isinstance(fd, MappedFile):
+            # Buffers can't be searched, but the mapping itself can
+            data, start = fd.map, self.img_offset
         else:
-            # We need to search
-            for i in range(len(img_data) - 2):
-                if img_data[i:i + 2] == EOI_MARKER:
-                    break
-            else:
+            data, start = img_data, 0
+        eoi = find_eoi(data, start)
+        if eoi < 0:
+            # Not a well formed scan, settle for the last EOI marker
+            eoi = data.rfind(EOI_MARKER, start)
+            if eoi < 0:
                 raise JpegFile.InvalidFile("Unable to find EOI marker.")
-            remaining = len(img_data) - i
-
-        self.img_data = img_data[:-remaining]
-        fd.seek(-remaining, 1)
-
-    def write(self, fd):
-        """Write segment data to a given file object"""
+        return eoi - start
+
+    def get_scans(self, src=None):
+        """Return a list of (offset, length) pairs giving the position
+        in the file of the entropy coded data of each scan. Baseline
+        images have a single scan, progressive images have several
+        separated by DHT and SOS segments. If the segment was read with
+        headers_only, src may be the file object it was read from; it
+        must be if the segment came from a JpegParser."""
+        if self.scans is None and self.end_finder is not None:
+            self.end_finder(src)
+        if self.scans is None:
+            if self.img_data is not None:
+                length, scans = index_scans(MappedFile(self.img_data), 0,
+                                            eoi_optional=True)
+                self.scans = [(self.img_offset + offset, length)
+                              for offset, length in scans]
+            elif src is not None:
+                length, self.scans = index_scans(src, self.img_offset)
+            else:
+                raise JpegFile.NoImageData("Image data was not read "
+                                           "(headers_only).")
+        return self.scans
+
+    def write(self, fd, src=None):
+        """Write segment data to a given file object. If src is given,
+        the image data is copied from the file object src (which should be
+        the file the segment was read from) rather than from img_data."""
+        if src is not None:
+            DefaultSegment.write(self, fd)
+            copy_range(src, fd, self.img_offset, self.img_length)
+            return
+        if self.img_data is None:
+            raise JpegFile.NoImageData("Image data was not read "
+                                       "(headers_only).")
         DefaultSegment.write(self, fd)
         fd.write(self.img_data)
 
     def dump(self, fd):
         """Dump as ascii readable data to a given file object"""
         print >> fd, " Section: [  SOS] Size: %6d Image data size: %6d" % \
-            (len(self.data), len(self.img_data))
+            (len(self.data), self.img_length)
+
+
+class TrailerSegment(DefaultSegment):
+    """Data following the EOI marker, such as the extra images of an
+    MPF file or the video of a motion photo. It has no marker or size
+    of its own and is written out, unchanged, after the EOI marker.
+    This instances of this class are created by JpegFile."""
+
+    __slots__ = ('length',)
+
+    def __init__(self, fd, mode, headers_only=False):
+        """Read the trailer from fd, which should be positioned just
+        after the EOI marker. If headers_only is set only the length of
+        the trailer is recorded and data is None. fd may be None (with
+        headers_only) when the trailer isn't available, in which case
+        data_offset and length are left for the caller to fill in."""
+        if fd is None:
+            offset = self.length = data = None
+        elif headers_only:
+            offset = fd.tell()
+            fd.seek(0, 2)
+            self.length = fd.tell() - offset
+            data = None
+        else:
+            offset = fd.tell()
+            data = fd.read()
+            self.length = len(data)
+        DefaultSegment.__init__(self, None, fd, data, mode)
+        self.code = "Trailer"
+        self.data_offset = offset
+
+    def write(self, fd, src=None):
+        """Write the trailer to a given file object. If src is given the
+        data is copied from the file object src (which should be the file
+        the trailer was read from) rather than from data."""
+        if src is not None:
+            copy_range(src, fd, self.data_offset, self.length)
+            return
+        if self.data is None:
+            raise JpegFile.NoImageData("Trailer data was not read "
+                                       "(headers_only).")
+        fd.write(self.data)
+
+    def dump(self, fd):
+        """Dump as ascii readable data to a given file object"""
+        print >> fd, " Section: [Trail] Size: %6d" % self.length
+
+
+
+# struct endianness character matching the native byte order of arrays
+NATIVE_ENDIAN = '<' if sys.byteorder == 'little' else '>'
+
+# array typecodes for 4 byte integers, which depend on the platform
+UINT32_ARRAY = [code for code in "IL" if array(code).itemsize == 4][0]
+INT32_ARRAY = [code for code in "il" if array(code).itemsize == 4][0]
+ARRAY_CODES = {"H": "H", "I": UINT32_ARRAY, "i": INT32_ARRAY}
 
 
 class ExifType:
     """The ExifType class encapsulates the data types used
     in the Exif spec. These should really be called TIFF types
-    probably. This could be replaced by named tuples in python 2.6."""
+    probably. This could be replaced by named tuples in python 2.6.
+
+    Numeric types have a struct format for a single component, and their
+    values are stored in arrays with the matching array_code. Rationals
+    are stored as numerator, denominator pairs."""
     lookup = {}
 
-    def __init__(self, type_id, name, size):
+    def __init__(self, type_id, name, size, fmt=None):
         """Create an ExifType with a given name, size and type_id"""
         self.id = type_id
         self.name = name
         self.size = size
+        self.fmt = fmt
+        self.array_code = None
+        if fmt is not None:
+            self.array_code = ARRAY_CODES[fmt[0]]
         ExifType.lookup[type_id] = self
 
+    def decode(self, e, data):
+        """Decode the string data, a whole value of this numeric type in
+        endianness e, into an array in one go."""
+        values = array(self.array_code)
+        values.fromstring(data)
+        if e != NATIVE_ENDIAN:
+            values.byteswap()
+        return values
+
+    def encode(self, e, values):
+        """Encode values, a whole value of this numeric type as an array or
+        list of integers, into a string with endianness e. This is the
+        reverse of decode."""
+        if not isinstance(values, array) or \
+                values.typecode != self.array_code or e != NATIVE_ENDIAN:
+            values = array(self.array_code, values)
+        if e != NATIVE_ENDIAN:
+            values.byteswap()
+        return values.tostring()
+
 BYTE = ExifType(1, "byte", 1).id
 ASCII = ExifType(2, "ascii", 1).id
-SHORT = ExifType(3, "short", 2).id
-LONG = ExifType(4, "long", 4).id
-RATIONAL = ExifType(5, "rational", 8).id
+SHORT = ExifType(3, "short", 2, "H").id
+LONG = ExifType(4, "long", 4, "I").id
+RATIONAL = ExifType(5, "rational", 8, "II").id
 UNDEFINED = ExifType(7, "undefined", 1).id
-SLONG = ExifType(9, "slong", 4).id
-SRATIONAL = ExifType(10, "srational", 8).id
+SLONG = ExifType(9, "slong", 4, "i").id
+SRATIONAL = ExifType(10, "srational", 8, "ii").id
 
 
 def exif_type_size(exif_type):
@@ -250,9 +753,101 @@ def exif_type_size(exif_type):
     return ExifType.lookup.get(exif_type).size
 
 
-class Rational:
+def encode_value(e, exif_type, the_data):
+    """Return the_data, the value of an entry of the given exif_type,
+    packed into a string using endianness e. the_data may be in either
+    the stored or the user facing representation."""
+    if exif_type == BYTE or exif_type == UNDEFINED:
+        return "".join(the_data)
+    elif exif_type == ASCII:
+        return the_data
+    elif exif_type in ExifType.lookup and ExifType.lookup[exif_type].fmt:
+        exif_type = ExifType.lookup[exif_type]
+        return exif_type.encode(e, stored_value(exif_type.id, the_data))
+    else:
+        raise "Can't handle this", exif_type
+
+
+def stored_value(exif_type, value):
+    """Convert value, as given by the user, to the compact representation
+    stored in an IFD: a string for BYTE, UNDEFINED and ASCII types and an
+    array for numeric types. Other values, such as IFDs, are unchanged."""
+    if not isinstance(value, (list, tuple)):
+        return value
+    if exif_type == BYTE or exif_type == UNDEFINED:
+        return "".join(value)
+    if exif_type not in ExifType.lookup or \
+            ExifType.lookup[exif_type].array_code is None:
+        return value
+    if exif_type == RATIONAL or exif_type == SRATIONAL:
+        values = []
+        for rational in value:
+            values.extend(rational.as_tuple())
+        value = values
+    return array(ExifType.lookup[exif_type].array_code, value)
+
+
+def user_value(exif_type, value):
+    """Convert a stored value to the representation given to the user:
+    a list of values (or a string for ASCII). A new list is returned each
+    time; IfdData wraps it in an IfdList so changes to it are kept."""
+    if isinstance(value, array):
+        if value.typecode == UINT32_ARRAY:
+            # Unsigned 32 bit arrays give longs, but values have always
+            # been ints where they fit
+            value = map(int, value)
+        if exif_type == RATIONAL or exif_type == SRATIONAL:
+            return [Rational(value[i], value[i + 1])
+                    for i in range(0, len(value), 2)]
+        return list(value)
+    if isinstance(value, str) and (exif_type == BYTE or
+                                   exif_type == UNDEFINED):
+        return list(value)
+    return value
+
+
+class IfdList(list):
+    """The list of values of an IFD entry, as returned by IfdData. Values
+    are stored compactly rather than as this list, so changing the list
+    (e.g. gps.GPSLatitude[2] = Rational(...)) assigns it back to the IFD.
+    Changing a Rational within it in place doesn't. It pickles and copies
+    as a plain list."""
+
+    __slots__ = ('ifd', 'tag')
+
+    def __init__(self, ifd, tag, values):
+        list.__init__(self, values)
+        self.ifd = ifd
+        self.tag = tag
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def _assigns_back(name):
+    """Return a version of the list method name for IfdList, which assigns
+    the list back to its IFD entry after calling it."""
+    method = getattr(list, name)
+
+    def assign_back(self, *args):
+        result = method(self, *args)
+        self.ifd[self.tag] = list(self)
+        return result
+    assign_back.__name__ = name
+    return assign_back
+
+for _name in ("__setitem__", "__delitem__", "__setslice__", "__delslice__",
+              "__iadd__", "__imul__", "append", "extend", "insert", "pop",
+              "remove", "reverse", "sort"):
+    setattr(IfdList, _name, _assigns_back(_name))
+del _name
+
+
+class Rational(object):
     """A simple fraction class. Python 2.6 could use the inbuilt Fraction class."""
 
+    __slots__ = ('num', 'den')
+
     def __init__(self, num, den):
         """Create a number fraction num/den."""
         self.num = num
@@ -267,12 +862,51 @@ class Rational:
         return (self.num, self.den)
 
 
+class RawValue(object):
+    """Placeholder for the value of an IFD entry which hasn't been
+    decoded yet. offset is the offset of the value in the IFD's data, or
+    for embedded IFDs the offset of the IFD."""
+
+    __slots__ = ('components', 'offset')
+
+    def __init__(self, components, offset):
+        self.components = components
+        self.offset = offset
+
+    def __len__(self):
+        return self.components
+
+
+class IfdMeta(type):
+    """Metaclass for IfdData which builds the indexes used to look up
+    tags by name when each IFD class is created."""
+
+    def __init__(cls, name, bases, attrs):
+        type.__init__(cls, name, bases, attrs)
+        # Maps names to tags, and names of embedded IFDs to (tag, class)
+        cls.tag_names = {}
+        for key, entry in cls.tags.items():
+            cls.tag_names.setdefault(entry[1], key)
+        cls.embedded_names = {}
+        for key, entry in cls.embedded_tags.items():
+            if entry[0] not in cls.tag_names:
+                cls.embedded_names[entry[0]] = (key, entry[1])
+
+
 class IfdData(object):
-    """Base class for IFD"""
+    """Base class for IFD. Values are stored compactly, see stored_value,
+    and converted to lists on access, see user_value."""
+
+    __metaclass__ = IfdMeta
+    __slots__ = ('exif_file', 'mode', 'e', 'entries', 'positions',
+                 'value_offsets', 'data', 'data_base', 'dirty')
 
     name = "Generic Ifd"
     tags = {}
     embedded_tags = {}
+    # Tags that are decoded when parsed, even when parsing lazily,
+    # because special_handler needs to see them.
+    special_tags = ()
 
     def special_handler(self, tag, data):
         """special_handler method can be over-ridden by subclasses
@@ -296,46 +930,46 @@ class IfdData(object):
         return self[key] is not None
 
     def __setattr__(self, name, value):
-        for key, entry in self.tags.items():
-            if entry[1] == name:
-                self[key] = value
-                return
+        key = self.tag_names.get(name)
+        if key is not None:
+            self[key] = value
+            return
 
-        for key, entry in self.embedded_tags.items():
-            if entry[0] == name:
-                if not isinstance(value, entry[1]):
-                    raise TypeError("Values assigned to '{}' must be instances of {}".format(entry[0], entry[1]))
-                self[key] = value
-                return
+        embedded = self.embedded_names.get(name)
+        if embedded is not None:
+            key, ifd_class = embedded
+            if not isinstance(value, ifd_class):
+                raise TypeError("Values assigned to '{}' must be instances of {}".format(name, ifd_class))
+            self[key] = value
+            return
 
         raise AttributeError("Invalid attribute '{}'".format(name))
 
     def __delattr__(self, name):
-        for key, entry in self.tags.items():
-            if entry[1] == name:
-                del self[key]
-                break
-        else:
+        key = self.tag_names.get(name)
+        if key is None:
             raise AttributeError("Invalid attribute '{}'".format(name))
+        del self[key]
 
     def __getattr__(self, name):
-        for key, entry in self.tags.items():
-            if entry[1] == name:
-                x = self[key]
-                if x is None:
-                    raise AttributeError
-                return x
-        for key, entry in self.embedded_tags.items():
-            if entry[0] == name:
-                if self.has_key(key):
-                    return self[key]
+        key = self.tag_names.get(name)
+        if key is not None:
+            x = self[key]
+            if x is None:
+                raise AttributeError
+            return x
+        embedded = self.embedded_names.get(name)
+        if embedded is not None:
+            key, ifd_class = embedded
+            if self.has_key(key):
+                return self[key]
+            else:
+                if self.mode == "rw":
+                    new = ifd_class(self.e, 0, "rw", self.exif_file)
+                    self[key] = new
+                    return new
                 else:
-                    if self.mode == "rw":
-                        new = entry[1](self.e, 0, "rw", self.exif_file)
-                        self[key] = new
-                        return new
-                    else:
-                        raise AttributeError
+                    raise AttributeError
         raise AttributeError("%s not found.. %s" % (name, self.embedded_tags))
 
     def __getitem__(self, key):
@@ -344,13 +978,18 @@ class IfdData(object):
                 return self.__getattr__(key)
             except AttributeError:
                 return None
-        for entry in self.entries:
-            if key == entry[0]:
-                if entry[1] == ASCII and not entry[2] is None:
-                    return entry[2].strip('\0')
-                else:
-                    return entry[2]
-        return None
+        i = self.entry_index(key)
+        if i is None:
+            return None
+        entry = self.decode_entry(i)
+        if entry is None:
+            return None
+        if entry[1] == ASCII and not entry[2] is None:
+            return entry[2].strip('\0')
+        value = user_value(entry[1], entry[2])
+        if isinstance(value, list):
+            return IfdList(self, key, value)
+        return value
 
     def __delitem__(self, key):
         if isinstance(key, str):
@@ -358,202 +997,354 @@ class IfdData(object):
                 return self.__delattr__(key)
             except AttributeError:
                 return None
-        for entry in self.entries:
-            if key == entry[0]:
-                self.entries.remove(entry)
+        if self.entry_index(key) is None:
+            return
+        object.__setattr__(self, 'dirty', True)
+        for i in range(len(self.entries) - 1, -1, -1):
+            if key == self.entries[i][0]:
+                del self.entries[i]
+        self.reindex()
 
     def __setitem__(self, key, value):
         if isinstance(key, str):
             return self.__setattr__(key, value)
-        found = 0
         if len(self.tags[key]) < 3:
             msg = "Error: Tags aren't set up correctly. Tag: {:x}:{} should have tag type."
             raise Exception(msg.format(key, self.tags[key]))
         if self.tags[key][2] == ASCII:
             if value is not None and not value.endswith('\0'):
                 value = value + '\0'
-        for i in range(len(self.entries)):
-            if key == self.entries[i][0]:
-                found = 1
-                entry = list(self.entries[i])
-                if value is None:
-                    del self.entries[i]
-                else:
-                    entry[2] = value
-                    self.entries[i] = tuple(entry)
-                break
-        if not found:
+        object.__setattr__(self, 'dirty', True)
+        i = self.entry_index(key)
+        if i is not None:
+            if value is None:
+                del self.entries[i]
+                self.reindex()
+            else:
+                exif_type = self.entries[i][1]
+                self.entries[i] = (key, exif_type,
+                                   stored_value(exif_type, value))
+        else:
             # Find type...
             # Not quite enough yet...
-            self.entries.append((key, self.tags[key][2], value))
+            exif_type = self.tags[key][2]
+            self.append_entry((key, exif_type, stored_value(exif_type, value)))
         return
 
+    def entry_index(self, key):
+        """Return the index in entries of the first entry with the tag key,
+        or None if there isn't one."""
+        count, positions = self.positions
+        if count != len(self.entries):
+            positions = self.reindex()
+        i = positions.get(key)
+        if i is not None and self.entries[i][0] != key:
+            # entries has been modified directly
+            positions = self.reindex()
+            i = positions.get(key)
+        return i
+
+    def reindex(self):
+        """Rebuild the index used by entry_index, and return it."""
+        positions = {}
+        for i in range(len(self.entries) - 1, -1, -1):
+            positions[self.entries[i][0]] = i
+        object.__setattr__(self, 'positions', (len(self.entries), positions))
+        return positions
+
+    def append_entry(self, entry):
+        """Append entry to entries, keeping the index up to date."""
+        count, positions = self.positions
+        if count == len(self.entries):
+            positions.setdefault(entry[0], count)
+            object.__setattr__(self, 'positions', (count + 1, positions))
+        self.entries.append(entry)
+
     def __init__(self, e, offset, exif_file, mode, data=None):
         object.__setattr__(self, 'exif_file', exif_file)
         object.__setattr__(self, 'mode', mode)
         object.__setattr__(self, 'e', e)
         object.__setattr__(self, 'entries', [])
+        # (len(entries), {tag: index of first entry}) used by entry_index
+        object.__setattr__(self, 'positions', (0, {}))
+        object.__setattr__(self, 'value_offsets', None)
+        # Lazily parsed entries are decoded from data on first access
+        lazy = getattr(exif_file, 'lazy', False)
+        object.__setattr__(self, 'data', data if lazy else None)
+        # Offset of the data this IFD was parsed from within the TIFF data
+        object.__setattr__(self, 'data_base', 0)
+        # Set when entries are changed through __setitem__/__delitem__
+        object.__setattr__(self, 'dirty', data is None)
 
         if data is None:
             return
 
-        num_entries = unpack(e + 'H', data[offset:offset+2])[0]
-        next = unpack(e + "I", data[offset+2+12*num_entries:
-                                    offset+2+12*num_entries+4])[0]
-        debug("OFFSET %s - %s" % (offset, next))
+        prof = profiler
+        if prof is not None:
+            prof_start = prof.clock()
+
+        # (tag, offset, exif_type, byte_size) of each value, in the order
+        # the entries were parsed
+        object.__setattr__(self, 'value_offsets', [])
+
+        table = ifd_entries(data, e, offset)
+        num_entries = len(table)
+        if DEBUG:
+            next = get_struct(e + "I").unpack_from(data,
+                                                   offset+2+12*num_entries)[0]
+            debug("OFFSET %s - %s" % (offset, next))
 
         for i in range(num_entries):
             start = (i * 12) + 2 + offset
-            debug("START: ", start)
-            entry = unpack(e + "HHII", data[start:start+12])
-            tag, exif_type, components, the_data = entry
-
-            debug("%s %s %s %s %s" % (hex(tag), exif_type,
-                                      exif_type_size(exif_type), components,
-                                      the_data))
+            tag, exif_type, components, the_data = table[i]
+            if DEBUG:
+                debug("START: ", start)
+                debug("%s %s %s %s %s" % (hex(tag), exif_type,
+                                          exif_type_size(exif_type),
+                                          components, the_data))
             byte_size = exif_type_size(exif_type) * components
+            if byte_size > 4:
+                value_offset = (tag, the_data, exif_type, byte_size)
+            else:
+                value_offset = (tag, start + 8, exif_type, byte_size)
 
             if tag in self.embedded_tags:
+                value_start = the_data
+            elif byte_size > 4:
+                if DEBUG:
+                    debug(" ...offset %s" % the_data)
+                value_start = the_data
+            else:
+                value_start = start + 8
+
+            if lazy and tag not in self.special_tags:
+                actual_data = RawValue(components, value_start)
+            else:
                 try:
-                    actual_data = self.embedded_tags[tag][1](e, the_data, exif_file, self.mode, data)
+                    actual_data = self.decode_value(tag, exif_type, components,
+                                                    value_start, data)
                 except JpegFile.SkipTag as exc:
                     # If the tag couldn't be parsed, and raised 'SkipTag'
                     # then we just continue.
                     continue
-            else:
-                if byte_size > 4:
-                    debug(" ...offset %s" % the_data)
-                    the_data = data[the_data:the_data+byte_size]
-                else:
-                    the_data = data[start+8:start+8+byte_size]
-
-                if exif_type == BYTE or exif_type == UNDEFINED:
-                    actual_data = list(the_data)
-                elif exif_type == ASCII:
-                    if the_data[-1] != '\0':
-                        actual_data = the_data + '\0'
-                        # raise JpegFile.InvalidFile("ASCII tag '%s' not
-                        # NULL-terminated: %s [%s]" % (self.tags.get(tag,
-                        # (hex(tag), 0))[0], the_data, map(ord, the_data)))
-                        # print "ASCII tag '%s' not NULL-terminated:
-                        # %s [%s]" % (self.tags.get(tag, (hex(tag), 0))[0],
-                        # the_data, map(ord, the_data))
-                    actual_data = the_data
-                elif exif_type == SHORT:
-                    actual_data = list(unpack(e + ("H" * components), the_data))
-                elif exif_type == LONG:
-                    actual_data = list(unpack(e + ("I" * components), the_data))
-                elif exif_type == SLONG:
-                    actual_data = list(unpack(e + ("i" * components), the_data))
-                elif exif_type == RATIONAL or exif_type == SRATIONAL:
-                    t = 'II' if exif_type == RATIONAL else 'ii'
-                    actual_data = []
-                    for i in range(components):
-                        actual_data.append(Rational(*unpack(e + t,
-                                                            the_data[i*8:
-                                                                     i*8+8])))
-                else:
-                    raise "Can't handle this"
 
-                if (byte_size > 4):
+                if DEBUG and byte_size > 4:
                     debug("%s" % actual_data)
 
-                self.special_handler(tag, actual_data)
             entry = (tag, exif_type, actual_data)
-            self.entries.append(entry)
+            self.append_entry(entry)
+            self.value_offsets.append(value_offset)
 
-            debug("%-40s %-10s %6d %s" % (self.tags.get(tag, (hex(tag), 0))[0],
-                                          ExifType.lookup[exif_type],
-                                          components, actual_data))
+            if DEBUG:
+                debug("%-40s %-10s %6d %s" % (
+                    self.tags.get(tag, (hex(tag), 0))[0],
+                    ExifType.lookup[exif_type], components, actual_data))
         self.ifd_handler(data)
+        if prof is not None:
+            prof.record("ifd." + type(self).__name__, prof_start,
+                        2 + 12 * num_entries + 4)
+
+    def decode_value(self, tag, exif_type, components, offset, data):
+        """Decode the value of an entry, starting at offset in data, into
+        its Python representation. For embedded tags offset is the offset
+        of the embedded IFD."""
+        if tag in self.embedded_tags:
+            return self.embedded_tags[tag][1](self.e, offset, self.exif_file,
+                                              self.mode, data)
+
+        e = self.e
+        byte_size = exif_type_size(exif_type) * components
+        the_data = data[offset:offset+byte_size]
+
+        if exif_type == BYTE or exif_type == UNDEFINED:
+            actual_data = the_data
+        elif exif_type == ASCII:
+            if the_data[-1] != '\0':
+                actual_data = the_data + '\0'
+                # raise JpegFile.InvalidFile("ASCII tag '%s' not
+                # NULL-terminated: %s [%s]" % (self.tags.get(tag,
+                # (hex(tag), 0))[0], the_data, map(ord, the_data)))
+                # print "ASCII tag '%s' not NULL-terminated:
+                # %s [%s]" % (self.tags.get(tag, (hex(tag), 0))[0],
+                # the_data, map(ord, the_data))
+            actual_data = the_data
+        elif exif_type in ExifType.lookup and ExifType.lookup[exif_type].fmt:
+            actual_data = ExifType.lookup[exif_type].decode(e, the_data)
+        else:
+            raise "Can't handle this"
+
+        self.special_handler(tag, actual_data)
+        return actual_data
+
+    def decode_entry(self, index):
+        """Decode the entry at index if it was parsed lazily, and return
+        the entry. If the entry turns out to be a tag which should be
+        skipped it is removed, and None is returned."""
+        tag, exif_type, the_data = self.entries[index]
+        if isinstance(the_data, RawValue):
+            try:
+                the_data = self.decode_value(tag, exif_type, the_data.components,
+                                             the_data.offset, self.data)
+            except JpegFile.SkipTag:
+                del self.entries[index]
+                if self.value_offsets is not None:
+                    del self.value_offsets[index]
+                self.reindex()
+                return None
+            self.entries[index] = (tag, exif_type, the_data)
+        return self.entries[index]
+
+    def decode_all(self, embedded_only=False):
+        """Decode all entries which were parsed lazily. If embedded_only
+        is true, only embedded IFDs are decoded."""
+        i = 0
+        while i < len(self.entries):
+            if embedded_only and self.entries[i][0] not in self.embedded_tags:
+                i += 1
+            elif self.decode_entry(i) is not None:
+                i += 1
 
     def isifd(self, other):
         """Return true if other is an IFD"""
         return issubclass(other.__class__, IfdData)
 
-    def getdata(self, e, offset, last=0):
-        data_offset = offset+2+len(self.entries)*12+4
-        output_data = ""
+    def is_modified(self):
+        """Return true if this IFD, or an IFD embedded in it, wasn't
+        parsed from a file or has been changed since. Changes made by
+        modifying entries directly are only noticed if they add or remove
+        entries."""
+        if self.dirty or self.value_offsets is None or \
+                len(self.entries) != len(self.value_offsets):
+            return True
+        for tag, exif_type, the_data in self.entries:
+            if self.isifd(the_data) and the_data.is_modified():
+                return True
+        return False
 
-        out_entries = []
+    def getdata(self, e, offset, last=0):
+        """Return a tuple of the IFD's data, encoded with endianness e to
+        be placed at offset, and the offset following it."""
+        out = bytearray()
+        next_offset = self.serialize(out, -offset, e, last)
+        return str(out), next_offset
+
+    def serialize(self, out, base, e, last=0):
+        """Append the IFD, followed by the data it refers to, to the
+        bytearray out. Offsets are relative to position base in out. If
+        last is false the offset following the data is stored as the
+        offset of the next IFD. Returns that offset.
+
+        The entry table has a fixed size, so it's reserved first and
+        filled in as the values and embedded IFDs are appended after
+        it, without copying any data that has already been written."""
+        # Embedded IFDs need to be decoded to be written out, and may be
+        # removed in the process.
+        self.decode_all(embedded_only=True)
+        entry_struct = get_struct(self.e + "HHI")
+        offset_struct = get_struct(e + "I")
+        start = len(out)
+        out += "\0" * (2 + len(self.entries) * 12 + 4)
+        get_struct(e + "H").pack_into(out, start, len(self.entries))
 
         # Add any specifc data for the particular type
-        extra_data = self.extra_ifd_data(data_offset)
-        data_offset += len(extra_data)
-        output_data += extra_data
+        out += self.extra_ifd_data(len(out) - base)
 
+        pos = start + 2
         for tag, exif_type, the_data in self.entries:
             magic_type = exif_type
             if (self.isifd(the_data)):
                 debug("-> Magic..")
-                sub_data, next_offset = the_data.getdata(e, data_offset, 1)
-                the_data = [data_offset]
-                debug("<- Magic", next_offset, data_offset, len(sub_data),
-                      data_offset + len(sub_data))
-                data_offset += len(sub_data)
-                assert(next_offset == data_offset)
-                output_data += sub_data
-                magic_type = exif_type
+                sub_start = len(out)
+                the_data.serialize(out, base, e, 1)
+                debug("<- Magic", sub_start - base, len(out) - base)
                 if exif_type != 4:
-                    magic_components = len(sub_data)
+                    magic_components = len(out) - sub_start
                 else:
                     magic_components = 1
-                exif_type = 4  # LONG
-                byte_size = 4
-                components = 1
-            else:
-                magic_components = components = len(the_data)
-                byte_size = exif_type_size(exif_type) * components
-
-            if exif_type == BYTE or exif_type == UNDEFINED:
-                actual_data = "".join(the_data)
-            elif exif_type == ASCII:
-                actual_data = the_data
-            elif exif_type == SHORT:
-                actual_data = pack(e + ("H" * components), *the_data)
-            elif exif_type == LONG:
-                actual_data = pack(e + ("I" * components), *the_data)
-            elif exif_type == SLONG:
-                actual_data = pack(e + ("i" * components), *the_data)
-            elif exif_type == RATIONAL or exif_type == SRATIONAL:
-                t = 'II' if exif_type == RATIONAL else 'ii'
-                actual_data = ""
-                for i in range(components):
-                    actual_data += pack(e + t, *the_data[i].as_tuple())
+                magic_type = exif_type
+                entry_struct.pack_into(out, pos, tag, magic_type,
+                                       magic_components)
+                offset_struct.pack_into(out, pos + 8, sub_start - base)
+                pos += 12
+                continue
+
+            if isinstance(the_data, RawValue):
+                # Not decoded, so just copy the original data
+                byte_size = exif_type_size(exif_type) * the_data.components
+                actual_data = data_slice(self.data, the_data.offset,
+                                         byte_size)
             else:
-                raise "Can't handle this", exif_type
-            if (byte_size) > 4:
-                output_data += actual_data
-                actual_data = pack(e + "I", data_offset)
-                data_offset += byte_size
+                actual_data = encode_value(e, exif_type, the_data)
+                byte_size = len(actual_data)
+            magic_components = byte_size / exif_type_size(exif_type)
+            entry_struct.pack_into(out, pos, tag, magic_type,
+                                   magic_components)
+            if byte_size > 4:
+                offset_struct.pack_into(out, pos + 8, len(out) - base)
+                out += actual_data
             else:
-                actual_data = actual_data + '\0' * (4 - len(actual_data))
-            out_entries.append((tag, magic_type,
-                                magic_components, actual_data))
-
-        data = pack(e + 'H', len(self.entries))
-        for entry in out_entries:
-            data += pack(self.e + "HHI", *entry[:3])
-            data += entry[3]
+                out[pos + 8:pos + 8 + byte_size] = actual_data
+            pos += 12
 
-        next_offset = data_offset
+        next_offset = len(out) - base
         if last:
-            data += pack(self.e + "I", 0)
+            get_struct(self.e + "I").pack_into(out, pos, 0)
         else:
-            data += pack(self.e + "I", next_offset)
-        data += output_data
-
-        assert (next_offset == offset+len(data))
+            get_struct(self.e + "I").pack_into(out, pos, next_offset)
+        return next_offset
+
+    def value_offset(self, tag):
+        """Return the absolute offset in the file of the value of tag as
+        it was parsed, or None if it wasn't parsed from a file."""
+        segment_offset = getattr(self.exif_file, 'data_offset', None)
+        if segment_offset is None or self.value_offsets is None:
+            return None
+        for value_tag, offset, _, _ in self.value_offsets:
+            if value_tag == tag:
+                return segment_offset + TIFF_OFFSET + self.data_base + offset
+        return None
 
-        return data, next_offset
+    def in_place_patches(self, patches):
+        """Append an (offset, data) tuple to patches for every value in
+        this IFD (and embedded IFDs) which has changed since it was parsed.
+        Return False if the IFD can't be updated in place, i.e. if entries
+        were added or removed, or a value no longer has the same size."""
+        segment_offset = getattr(self.exif_file, 'data_offset', None)
+        if segment_offset is None or self.value_offsets is None or \
+                len(self.entries) != len(self.value_offsets):
+            return False
+        original = self.exif_file.data
+        base = TIFF_OFFSET + self.data_base
+        for entry, value_offset in zip(self.entries, self.value_offsets):
+            tag, exif_type, the_data = entry
+            orig_tag, offset, orig_type, byte_size = value_offset
+            if tag != orig_tag:
+                return False
+            if isinstance(the_data, RawValue):
+                continue
+            if self.isifd(the_data):
+                if the_data.exif_file is not self.exif_file or \
+                        not the_data.in_place_patches(patches):
+                    return False
+                continue
+            if exif_type != orig_type:
+                return False
+            new_data = encode_value(self.e, exif_type, the_data)
+            if len(new_data) != byte_size:
+                return False
+            if original[base + offset:base + offset + byte_size] != new_data:
+                patches.append((segment_offset + base + offset, new_data))
+        return True
 
     def dump(self, f, indent=""):
         """Dump the IFD file"""
         print >> f, indent + "<--- %s start --->" % self.name
+        self.decode_all()
         for entry in self.entries:
             tag, exif_type, data = entry
             if exif_type == ASCII:
                 data = data.strip('\0')
+            data = user_value(exif_type, data)
             if (self.isifd(data)):
                 data.dump(f, indent + "    ")
             else:
@@ -565,6 +1356,7 @@ class IfdData(object):
 
 
 class IfdInterop(IfdData):
+    __slots__ = ()
     name = "Interop"
     tags = {
         # Interop stuff
@@ -577,6 +1369,7 @@ class IfdInterop(IfdData):
 
 
 class CanonIFD(IfdData):
+    __slots__ = ()
     tags = {
         0x0006: ("Image Type", "ImageType"),
         0x0007: ("Firmware Revision", "FirmwareRevision"),
@@ -589,6 +1382,7 @@ class CanonIFD(IfdData):
 
 
 class FujiIFD(IfdData):
+    __slots__ = ()
     tags = {
         0x0000: ("Note version", "NoteVersion"),
         0x1000: ("Quality", "Quality"),
@@ -611,11 +1405,13 @@ class FujiIFD(IfdData):
         }
     name = "FujiFilm"
 
-    def getdata(self, e, offset, last=0):
-        pre_data = "FUJIFILM"
-        pre_data += pack("<I", 12)
-        data, next_offset = IfdData.getdata(self, e, 12, last)
-        return pre_data + data, next_offset + offset
+    def serialize(self, out, base, e, last=0):
+        # Offsets within the maker note are relative to its start
+        start = len(out)
+        out += "FUJIFILM"
+        out += pack("<I", 12)
+        IfdData.serialize(self, out, start, e, last)
+        return len(out) - base
 
 
 def ifd_maker_note(e, offset, exif_file, mode, data):
@@ -635,13 +1431,15 @@ def ifd_maker_note(e, offset, exif_file, mode, data):
                                        "Expecting a makernote header "
                                        "<FUJIFILM>. Got <%s>." % header)
         # The it has its own offset
-        ifd_offset = unpack("<I", data[offset+8:offset+12])[0]
+        ifd_offset = unpack_from("<I", data, offset+8)[0]
         # and it is always litte-endian
         e = "<"
         # and the data is referenced from the start the Ifd data, not the
         # TIFF file.
-        ifd_data = data[offset:]
-        return FujiIFD(e, ifd_offset, exif_file, mode, ifd_data)
+        ifd_data = data_slice(data, offset, len(data) - offset)
+        ifd = FujiIFD(e, ifd_offset, exif_file, mode, ifd_data)
+        object.__setattr__(ifd, 'data_base', offset)
+        return ifd
     else:
         if unknown_maker_note_as_error:
             msg = "Unknown maker: %s. Can't currently handle this." % \
@@ -654,6 +1452,7 @@ def ifd_maker_note(e, offset, exif_file, mode, data):
 
 
 class IfdGPS(IfdData):
+    __slots__ = ()
     name = "GPS"
     tags = {
         0x0: ("GPS tag version", "GPSVersionID", BYTE, 4),
@@ -672,6 +1471,7 @@ class IfdGPS(IfdData):
 
 
 class IfdExtendedEXIF(IfdData):
+    __slots__ = ()
     tags = {
         # Exif IFD Attributes
         # A. Tags relating to version
@@ -750,6 +1550,8 @@ class IfdTIFF(IfdData):
     """
     """
 
+    __slots__ = ()
+
     tags = {
         # Private Tags
         0x8769: ("Exif IFD Pointer", "ExifOffset", LONG),
@@ -799,6 +1601,7 @@ class IfdTIFF(IfdData):
         }
 
     name = "TIFF Ifd"
+    special_tags = (0x10f,)
 
     def special_handler(self, tag, data):
         if tag in self.tags and self.tags[tag][1] == "Make":
@@ -814,33 +1617,63 @@ class IfdTIFF(IfdData):
 
 
 class IfdThumbnail(IfdTIFF):
+    """The IFD of the thumbnail image. The thumbnail's JPEG data isn't
+    copied when the IFD is parsed, only a reference to where it is in
+    the EXIF data is kept. Use get_thumbnail() or write_thumbnail() to
+    get at it."""
+    __slots__ = ('thumbnail',)
     name = "Thumbnail"
 
+    def __init__(self, e, offset, exif_file, mode, data=None):
+        # (data, offset, length) of the thumbnail, see ifd_handler
+        object.__setattr__(self, 'thumbnail', None)
+        IfdTIFF.__init__(self, e, offset, exif_file, mode, data)
+
     def ifd_handler(self, data):
-        size = None
-        offset = None
-        for (tag, exif_type, val) in self.entries:
-            if (tag == 0x201):
-                offset = val[0]
-            if (tag == 0x202):
-                size = val[0]
+        size = self[0x202]
+        offset = self[0x201]
+        if size is not None:
+            size = size[0]
+        if offset is not None:
+            offset = offset[0]
         if size is None or offset is None:
             raise JpegFile.InvalidFile("Thumbnail doesn't have an offset "
                                        "and/or size")
-        object.__setattr__(self, 'jpeg_data', data[offset:offset+size])
-        if len(self.jpeg_data) != size:
+        if offset + size > len(data):
             raise JpegFile.InvalidFile("Not enough data for JPEG thumbnail."
                                        "Wanted: %d got %d" %
-                                       (size, len(self.jpeg_data)))
+                                       (size, max(0, len(data) - offset)))
+        object.__setattr__(self, 'thumbnail', (data, offset, size))
+
+    def get_thumbnail(self):
+        """Return the JPEG data of the thumbnail as a string, or None if
+        there isn't one."""
+        if self.thumbnail is None:
+            return None
+        data, offset, size = self.thumbnail
+        return str(buffer(data, offset, size))
+
+    jpeg_data = property(get_thumbnail)
+
+    def write_thumbnail(self, fd):
+        """Write the JPEG data of the thumbnail to the file object fd,
+        without copying it first."""
+        if self.thumbnail is None:
+            raise JpegFile.NoSection("There is no thumbnail.")
+        data, offset, size = self.thumbnail
+        fd.write(buffer(data, offset, size))
 
     def extra_ifd_data(self, offset):
         for i in range(len(self.entries)):
             entry = self.entries[i]
             if entry[0] == 0x201:
                 # Print found field and updating
-                new_entry = (entry[0], entry[1], [offset])
+                new_entry = (entry[0], entry[1], stored_value(entry[1], [offset]))
                 self.entries[i] = new_entry
-        return self.jpeg_data
+        if self.thumbnail is None:
+            return ""
+        data, start, size = self.thumbnail
+        return buffer(data, start, size)
 
 
 class ExifSegment(DefaultSegment):
@@ -851,11 +1684,18 @@ class ExifSegment(DefaultSegment):
     a get_attributes returns an AttributeIfd instances which allows you to
     manipulate the attributes in a Jpeg file."""
 
-    def __init__(self, marker, fd, data, mode):
+    __slots__ = ('ifds', 'e', 'tiff_endian', 'lazy', 'make', 'parsed_ifds')
+
+    def __init__(self, marker, fd, data, mode, lazy=False):
+        """If lazy is true, the values in the IFDs are only decoded
+        when they are first accessed."""
         self.ifds = []
         self.e = '<'
         self.tiff_endian = 'II'
+        self.lazy = lazy
         DefaultSegment.__init__(self, marker, fd, data, mode)
+        # The IFDs as parsed, to tell whether ifds has been changed
+        self.parsed_ifds = list(self.ifds)
 
     def parse_data(self, data):
         """Overloads the DefaultSegment method to parse the data of
@@ -867,7 +1707,7 @@ class ExifSegment(DefaultSegment):
             raise self.InvalidSegment("Bad Exif Marker. Got <%s>, "
                                       "expecting <Exif>" % exif)
 
-        tiff_data = data[TIFF_OFFSET:]
+        tiff_data = data_slice(data, TIFF_OFFSET, len(data) - TIFF_OFFSET)
         data = None  # Don't need or want data for now on.
 
         self.tiff_endian = tiff_data[:2]
@@ -880,7 +1720,7 @@ class ExifSegment(DefaultSegment):
                                        "expecting <II> or <MM>" %
                                        self.tiff_endian)
 
-        tiff_tag, tiff_offset = unpack(self.e + 'HI', tiff_data[2:8])
+        tiff_tag, tiff_offset = unpack_from(self.e + 'HI', tiff_data, 2)
 
         if (tiff_tag != TIFF_TAG):
             raise JpegFile.InvalidFile("Bad TIFF tag. Got <%x>, expecting "
@@ -896,7 +1736,7 @@ class ExifSegment(DefaultSegment):
 
         while offset:
             count += 1
-            num_entries = unpack(self.e + 'H', tiff_data[offset:offset+2])[0]
+            num_entries = unpack_from(self.e + 'H', tiff_data, offset)[0]
             start = 2 + offset + (num_entries*12)
             if (count == 1):
                 ifd = IfdTIFF(self.e, offset, self, self.mode, tiff_data)
@@ -907,29 +1747,39 @@ class ExifSegment(DefaultSegment):
             self.ifds.append(ifd)
 
             # Get next offset
-            offset = unpack(self.e + "I", tiff_data[start:start+4])[0]
+            offset = unpack_from(self.e + "I", tiff_data, start)[0]
 
     def dump(self, fd):
         print >> fd, " Section: [ EXIF] Size: %6d" % (len(self.data))
         for ifd in self.ifds:
             ifd.dump(fd)
 
+    def is_modified(self):
+        """Return true if the segment wasn't parsed from a file, or any of
+        its IFDs have been changed since."""
+        if self.data is None or self.ifds != self.parsed_ifds:
+            return True
+        for ifd in self.ifds:
+            if ifd.is_modified():
+                return True
+        return False
+
     def get_data(self):
-        ifds_data = ""
-        next_offset = 8
+        if not self.is_modified():
+            # Write out exactly what was read
+            return self.data
+        prof = profiler
+        if prof is not None:
+            prof_start = prof.clock()
+        out = bytearray("Exif\0\0")
+        out += self.tiff_endian
+        out += pack(self.e + "HI", 42, 8)
         for ifd in self.ifds:
             debug("OUT IFD")
-            new_data, next_offset = ifd.getdata(self.e, next_offset,
-                                                ifd == self.ifds[-1])
-            ifds_data += new_data
-
-        data = ""
-        data += "Exif\0\0"
-        data += self.tiff_endian
-        data += pack(self.e + "HI", 42, 8)
-        data += ifds_data
-
-        return data
+            ifd.serialize(out, TIFF_OFFSET, self.e, ifd == self.ifds[-1])
+        if prof is not None:
+            prof.record("serialize", prof_start, len(out))
+        return str(out)
 
     def get_primary(self, create=False):
         """Return the attributes image file descriptor. If it doesn't
@@ -988,6 +1838,9 @@ jpeg_markers = {
 
 APP1 = 0xe1
 
+# Markers of the start of frame segments, which hold the image dimensions
+SOF_MARKERS = frozenset(range(0xc0, 0xd0)) - frozenset([0xc4, 0xc8, 0xcc])
+
 
 class JpegFile:
     """JpegFile object. You should create this using one of the static methods
@@ -996,22 +1849,106 @@ class JpegFile:
     writeFile, writeString or writeFd. To get an ASCII dump of the data in a file
     use the dump method."""
 
-    def fromFile(filename, mode="rw"):
-        """Return a new JpegFile object from a given filename."""
+    def fromFile(filename, mode="rw", headers_only=False, use_mmap=False,
+                 lazy=False):
+        """Return a new JpegFile object from a given filename. If
+        headers_only is true only the segments up to the Start-of-Scan
+        header are read, which makes reading the meta-data of large
+        images much cheaper. The end of the image data, and any trailer
+        after it, are only found when first needed (by dump, rewrite,
+        patch_in_place, remove_metadata or the img_length of the
+        Start-of-Scan segment), by reading through the image data a chunk
+        at a time. Such a JpegFile can only be written out with rewrite.
+
+        If use_mmap is true the file is memory mapped, and the segments
+        refer directly to the mapped memory rather than holding copies
+        of the data.
+
+        If lazy is true, EXIF values (including embedded IFDs) are only
+        decoded when they are first accessed. Values which are never
+        accessed are written out exactly as they were read.
+
+        If the module global metadata_cache is set, files opened with
+        mode="ro" (and not use_mmap) are returned from the cache."""
+        if metadata_cache is not None and mode == "ro" and not use_mmap:
+            return metadata_cache.load(filename, headers_only, lazy)
         with open(filename, "rb") as f:
-            return JpegFile(f, filename=filename, mode=mode)
+            if use_mmap:
+                try:
+                    map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    # Raised when trying to map an empty file
+                    raise JpegFile.InvalidFile("Unable to map <%s>." %
+                                               filename)
+                f = MappedFile(map)
+            return JpegFile(f, filename=filename, mode=mode,
+                            headers_only=headers_only, lazy=lazy)
     fromFile = staticmethod(fromFile)
 
-    def fromString(str, mode="rw"):
+    def fromString(str, mode="rw", headers_only=False, lazy=False):
         """Return a new JpegFile object taking data from a string."""
-        return JpegFile(StringIO.StringIO(str), "from buffer", mode=mode)
+        return JpegFile(StringIO.StringIO(str), "from buffer", mode=mode,
+                        headers_only=headers_only, lazy=lazy)
     fromString = staticmethod(fromString)
 
-    def fromFd(fd, mode="rw"):
+    def fromFd(fd, mode="rw", headers_only=False, lazy=False):
         """Return a new JpegFile object taking data from a file object."""
-        return JpegFile(fd, "fd <%d>" % fd.fileno(), mode=mode)
+        return JpegFile(fd, "fd <%d>" % fd.fileno(), mode=mode,
+                        headers_only=headers_only, lazy=lazy)
     fromFd = staticmethod(fromFd)
 
+    def read_tags(filename, tags):
+        """Return a dictionary mapping each of the tag names in tags to its
+        value in the primary, Extended EXIF, GPS or Interoperability IFD of
+        the file named filename, or None if the file doesn't have it. Only
+        the IFDs holding the requested tags are read, and values are
+        decoded straight from the EXIF data without creating any IFD
+        objects, which makes this much cheaper than fromFile for looking
+        up a few tags.
+
+        The value of MakerNote is the raw data of the maker note, as a
+        string. Asking for an embedded IFD, such as GPS, raises KeyError."""
+        result = dict.fromkeys(tags)
+        # {ifd class: {tag: name}} of the requested tags
+        wanted = {}
+        for name in tags:
+            for ifd_class in (IfdTIFF, IfdExtendedEXIF, IfdGPS, IfdInterop):
+                if name in ifd_class.embedded_names:
+                    raise KeyError(name)
+                tag = ifd_class.tag_names.get(name)
+                if tag is None:
+                    continue
+                if tag in ifd_class.embedded_tags and \
+                        ifd_class.embedded_tags[tag][0] != "MakerNote":
+                    raise KeyError(name)
+                wanted.setdefault(ifd_class, {})[tag] = name
+                break
+        if not wanted:
+            return result
+
+        tiff_data, e, tables = read_ifd_tables(filename, wanted)
+        try:
+            for ifd_class, names in wanted.items():
+                table = tables.get(ifd_class, {})
+                for tag, name in names.items():
+                    if tag not in table:
+                        continue
+                    if tag in ifd_class.embedded_tags:
+                        # The maker note, which is returned undecoded
+                        exif_type, components, offset = table[tag]
+                        size = exif_type_size(exif_type) * components
+                        if offset + size > len(tiff_data):
+                            raise JpegFile.InvalidFile(
+                                "Truncated maker note in <%s>." % filename)
+                        result[name] = str(tiff_data[offset:offset + size])
+                    else:
+                        result[name] = read_value(tiff_data, e, *table[tag])
+        except StructError:
+            raise JpegFile.InvalidFile("Truncated EXIF data in <%s>." %
+                                       filename)
+        return result
+    read_tags = staticmethod(read_tags)
+
     class SkipTag(Exception):
         """This exception is raised if a give tag should be skipped."""
         pass
@@ -1024,16 +1961,37 @@ class JpegFile:
         """This exception is raised if a section is unable to be found."""
         pass
 
-    def __init__(self, input, filename=None, mode="rw"):
+    class NoImageData(Exception):
+        """This exception is raised when trying to write out a file
+        which was read with headers_only."""
+        pass
+
+    def __init__(self, input, filename=None, mode="rw", headers_only=False,
+                 lazy=False):
         """JpegFile Constructor. input is a file object, and filename
         is a string used to name the file. (filename is used only for
         display functions).  You shouldn't use this function directly,
         but rather call one of the static methods fromFile, fromString
-        or fromFd."""
+        or fromFd. If input is None the JpegFile has no segments; this
+        is used by JpegParser.
+
+        With headers_only, the end of the image data is later found in
+        input, which must still be open then, unless input is a file
+        opened by name, which is opened again."""
         self.filename = filename
         self.mode = mode
+        self.headers_only = headers_only
+        # The file object or name the image data is in, until _find_end
+        self._end_source = None
+        if input is None:
+            self._segments = []
+            return
+        prof = profiler
+        if prof is not None:
+            prof_start = prof.clock()
+            prof_offset = input.tell()
         # input is the file descriptor
-        soi_marker = input.read(len(SOI_MARKER))
+        soi_marker = str(input.read(len(SOI_MARKER)))
 
         # The very first thing should be a start of image marker
         if (soi_marker != SOI_MARKER):
@@ -1050,27 +2008,91 @@ class JpegFile:
                                        "Got <%s> should be <%s>" %
                                        (delim, DELIM))
             if mark == EOI:
-                # Hit end of image marker, game-over!
+                # Hit end of image marker, game-over! Anything after it
+                # is kept as a trailer.
+                offset = input.tell()
+                input.seek(0, 2)
+                if input.tell() > offset:
+                    input.seek(offset)
+                    segments.append(TrailerSegment(input, self.mode,
+                                                   headers_only))
                 break
             head2 = input.read(2)
             size = unpack(">H", head2)[0]
+            data_offset = input.tell()
             data = input.read(size-2)
-            possible_segment_classes = jpeg_markers[mark][1] + [DefaultSegment]
-            # Try and find a valid segment class to handle
-            # this data
-            for segment_class in possible_segment_classes:
-                try:
-                    # Note: Segment class may modify the input file
-                    # descriptor. This is expected.
-                    attempt = segment_class(mark, input, data, self.mode)
-                    segments.append(attempt)
-                    break
-                except DefaultSegment.InvalidSegment:
-                    # It wasn't this one so we try the next type.
-                    # DefaultSegment will always work.
-                    continue
+            segment = self._parse_segment(mark, input, data, self.mode,
+                                          headers_only, lazy)
+            segment.data_offset = data_offset
+            segments.append(segment)
+            if headers_only and isinstance(segment, StartOfScanSegment):
+                # Leave the image data, and any trailer, until needed
+                if isinstance(input, file) and not input.name.startswith("<"):
+                    self._end_source = os.path.abspath(input.name)
+                else:
+                    self._end_source = input
+                segment.end_finder = self._find_end
+                break
 
         self._segments = segments
+        if prof is not None:
+            prof.record("scan", prof_start, input.tell() - prof_offset)
+
+    def _parse_segment(mark, input, data, mode, headers_only=False,
+                       lazy=False):
+        """Return a new segment for the segment data with the given marker,
+        read from the file object input."""
+        possible_segment_classes = jpeg_markers[mark][1] + [DefaultSegment]
+        prof = profiler
+        if prof is not None:
+            prof_start = prof.clock()
+        # Try and find a valid segment class to handle
+        # this data
+        for segment_class in possible_segment_classes:
+            try:
+                # Note: Segment class may modify the input file
+                # descriptor. This is expected.
+                if segment_class is StartOfScanSegment:
+                    segment = segment_class(mark, input, data, mode,
+                                            headers_only)
+                elif segment_class is ExifSegment:
+                    segment = segment_class(mark, input, data, mode, lazy)
+                else:
+                    segment = segment_class(mark, input, data, mode)
+            except DefaultSegment.InvalidSegment:
+                # It wasn't this one so we try the next type.
+                # DefaultSegment will always work.
+                continue
+            if prof is not None:
+                prof.record("segment." + segment_class.__name__,
+                            prof_start, len(data))
+            return segment
+    _parse_segment = staticmethod(_parse_segment)
+
+    def _find_end(self, src=None):
+        """Find the end of the image data, and any trailer after it, of a
+        file read with headers_only. src is the file object the file was
+        read from; if it isn't given the file is opened again."""
+        source = self._end_source
+        if source is None:
+            return
+        if src is None:
+            if isinstance(source, basestring):
+                with open(source, "rb") as src:
+                    return self._find_end(src)
+            src = source
+        for sos in self._segments:
+            if isinstance(sos, StartOfScanSegment):
+                break
+        sos.find_end(src)
+        sos.end_finder = None
+        self._end_source = None
+        offset = sos.img_offset + sos.img_length + len(EOI_MARKER)
+        src.seek(0, 2)
+        if src.tell() > offset:
+            src.seek(offset)
+            self._segments.append(TrailerSegment(src, self.mode,
+                                                 headers_only=True))
 
     def writeString(self):
         """Write the JpegFile out to a string. Returns a string."""
@@ -1080,19 +2102,124 @@ class JpegFile:
 
     def writeFile(self, filename):
         """Write the JpegFile out to a file named filename."""
-        output = open(filename, "wb")
-        self.writeFd(output)
-
-    def writeFd(self, output):
-        """Write the JpegFile out on the file object output."""
+        with open(filename, "wb") as output:
+            self.writeFd(output)
+
+    def writeFd(self, output, src=None):
+        """Write the JpegFile out on the file object output. If src is
+        given the image data is copied from the file object src, rather
+        than from memory."""
+        if src is not None:
+            self._find_end(src)
+        prof = profiler
+        if prof is not None:
+            prof_start = prof.clock()
+            prof_offset = _tell(output)
         output.write(SOI_MARKER)
+        trailers = []
         for segment in self._segments:
-            segment.write(output)
+            if isinstance(segment, TrailerSegment):
+                trailers.append(segment)
+            elif isinstance(segment, StartOfScanSegment):
+                segment.write(output, src)
+            else:
+                segment.write(output)
         output.write(EOI_MARKER)
+        for segment in trailers:
+            segment.write(output, src)
+        if prof is not None:
+            end = _tell(output)
+            nbytes = 0
+            if end is not None and prof_offset is not None:
+                nbytes = end - prof_offset
+            prof.record("write", prof_start, nbytes)
+
+    def rewrite(self, src_path, dst_path, sync=False):
+        """Write the JpegFile out to the file named dst_path, copying the
+        image data directly from src_path, the file this JpegFile was read
+        from. Only the meta-data segments are taken from memory, so this
+        works with files read using headers_only.
+
+        The new file is written to a temporary file which then replaces
+        dst_path, so src_path and dst_path may be the same file, and
+        dst_path is never left half written. If sync is true the temporary
+        file is flushed to disk before it replaces dst_path, and the
+        directory afterwards, so the replacement survives a crash."""
+        dst_dir = os.path.dirname(os.path.abspath(dst_path))
+        fd, tmp_path = tempfile.mkstemp(dir=dst_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as output:
+                with open(src_path, "rb") as src:
+                    self.writeFd(output, src)
+                if sync:
+                    output.flush()
+                    os.fsync(output.fileno())
+            if os.path.exists(dst_path):
+                shutil.copymode(dst_path, tmp_path)
+            else:
+                shutil.copymode(src_path, tmp_path)
+            os.rename(tmp_path, dst_path)
+        except:
+            os.unlink(tmp_path)
+            raise
+        if sync:
+            dir_fd = os.open(dst_dir, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def patch_in_place(self, filename):
+        """Write out changes to the file named filename, which must be the
+        file this JpegFile was read from. If the only changes are to EXIF
+        values whose size hasn't changed, just the changed bytes are written
+        into the existing file. Otherwise the file is rewritten using
+        rewrite(). Returns True if the file was patched in place."""
+        patches = self._in_place_patches()
+        if patches is None:
+            self.rewrite(filename, filename)
+            return False
+        if patches:
+            with open(filename, "r+b") as output:
+                for offset, data in patches:
+                    output.seek(offset)
+                    output.write(data)
+        return True
+
+    def _in_place_patches(self):
+        """Return a list of (offset, data) patches which update the file
+        this JpegFile was read from, or None if the segments no longer
+        match the layout of that file."""
+        patches = []
+        pos = len(SOI_MARKER)
+        for segment in self._segments:
+            if isinstance(segment, TrailerSegment):
+                if segment.data_offset != pos + len(EOI_MARKER):
+                    return None
+                continue
+            if segment.data_offset != pos + 4:
+                return None
+            pos = segment.data_offset + len(segment.data)
+            if isinstance(segment, ExifSegment):
+                # IFDs which were added or removed can't be patched
+                if segment.ifds != segment.parsed_ifds:
+                    return None
+                for ifd in segment.ifds:
+                    if not ifd.in_place_patches(patches):
+                        return None
+            elif isinstance(segment, StartOfScanSegment):
+                if segment.img_offset != pos:
+                    return None
+                if self._end_source is not None:
+                    # The image data and trailer haven't been looked at
+                    break
+                pos += segment.img_length
+        return patches
 
     def dump(self, f=sys.stdout):
         """Write out ASCII representation of the file on a given file
         object. Output default to stdout."""
+        self._find_end()
         print >> f, "<Dump of JPEG %s>" % self.filename
         for segment in self._segments:
             segment.dump(f)
@@ -1151,6 +2278,8 @@ class JpegFile:
         """
         paranoid_keep_list = ['SOF0', 'SOF2', 'DHT', 'SOS', 'DQT', 'DRI']
         if paranoid:
+            # Any trailer is removed too, so it must be found first
+            self._find_end()
             self._segments = [seg for seg in self._segments if
                               seg.code in paranoid_keep_list]
         else:
@@ -1167,6 +2296,16 @@ class JpegFile:
         new_seg = [seg for seg in other._segments if seg.code == 'COM' or seg.code.startswith('APP')]
         self._segments = new_seg + self._segments
 
+    def get_dimensions(self):
+        """Return a tuple of the (width, height) of the image, as given by
+        its start of frame segment, or None if it doesn't have one."""
+        for segment in self._segments:
+            if segment.marker in SOF_MARKERS and segment.data is not None \
+                    and len(segment.data) >= 5:
+                height, width = unpack_from(">HH", segment.data, 1)
+                return width, height
+        return None
+
     def get_geo(self):
         """Return a tuple of (latitude, longitude)."""
         def convert(x):
@@ -1230,3 +2369,452 @@ class JpegFile:
         gps.GPSLongitude = [Rational(deg, 1),
                             Rational(min, 1),
                             Rational(sec, JpegFile.SEC_DEN)]
+
+
+def find_exif(fd):
+    """Return a tuple of the offset and length of the data of the EXIF
+    segment in the JPEG file object fd, or None if it doesn't have one.
+    Only the segment headers are read, other segments are seeked over."""
+    fd.seek(0)
+    if str(fd.read(len(SOI_MARKER))) != SOI_MARKER:
+        raise JpegFile.InvalidFile("Error reading soi_marker.")
+    while 1:
+        head = str(fd.read(4))
+        if len(head) < 2:
+            return None
+        delim, mark = unpack_from(">BB", head)
+        if delim != DELIM:
+            raise JpegFile.InvalidFile("Error, expecting delimiter. "
+                                       "Got <%s> should be <%s>" %
+                                       (delim, DELIM))
+        if mark == SOS or mark == EOI or len(head) < 4:
+            return None
+        size = unpack_from(">H", head, 2)[0]
+        offset = fd.tell()
+        if mark == APP1 and str(fd.read(6)) == "Exif\0\0":
+            return offset, size - 2
+        fd.seek(offset + size - 2)
+
+
+def exif_tiff_data(data):
+    """Return a tuple of a buffer of the TIFF data within data, the data
+    of an EXIF segment, and the struct endianness character it uses."""
+    if str(data[TIFF_OFFSET:TIFF_OFFSET + 2]) == "MM":
+        e = ">"
+    else:
+        e = "<"
+    return buffer(data, TIFF_OFFSET), e
+
+
+def read_ifd_table(tiff_data, e, offset):
+    """Return a dictionary mapping tags to (exif_type, components,
+    value offset) for the entries of the IFD at offset in tiff_data."""
+    entries = {}
+    table = ifd_entries(tiff_data, e, offset)
+    for i, (tag, exif_type, components, value) in enumerate(table):
+        if exif_type not in ExifType.lookup:
+            continue
+        if exif_type_size(exif_type) * components <= 4:
+            value = offset + 2 + i * 12 + 8
+        entries.setdefault(tag, (exif_type, components, value))
+    return entries
+
+
+def read_ifd_tables(filename, ifd_classes):
+    """Return a tuple (tiff_data, e, tables) for the file named filename,
+    where tables maps each of ifd_classes (IfdTIFF and the classes of the
+    IFDs embedded in it) which the file has to its entries, as returned
+    by read_ifd_table. Only the EXIF segment of the file is read. If the
+    file has no EXIF segment tiff_data and e are None."""
+    with open(filename, "rb") as f:
+        found = find_exif(f)
+        if found is None:
+            return None, None, {}
+        f.seek(found[0])
+        tiff_data, e = exif_tiff_data(f.read(found[1]))
+
+    try:
+        ifd_offset = unpack_from(e + "I", tiff_data, 4)[0]
+        primary = read_ifd_table(tiff_data, e, ifd_offset)
+        tables = {IfdTIFF: primary}
+        for tag, (_, ifd_class) in IfdTIFF.embedded_tags.items():
+            if ifd_class in ifd_classes and tag in primary:
+                ifd_offset = read_value(tiff_data, e, *primary[tag])[0]
+                tables[ifd_class] = read_ifd_table(tiff_data, e, ifd_offset)
+    except StructError:
+        raise JpegFile.InvalidFile("Truncated EXIF data in <%s>." %
+                                   filename)
+    return tiff_data, e, tables
+
+
+def read_value(tiff_data, e, exif_type, components, offset):
+    """Decode the value at offset in tiff_data as IfdData would return
+    it: a string for ASCII values, otherwise a list."""
+    byte_size = exif_type_size(exif_type) * components
+    the_data = str(tiff_data[offset:offset + byte_size])
+    if len(the_data) < byte_size:
+        raise StructError("Value at offset %d is truncated." % offset)
+    if exif_type == ASCII:
+        return the_data.strip("\0")
+    if exif_type == BYTE or exif_type == UNDEFINED:
+        return list(the_data)
+    return user_value(exif_type, ExifType.lookup[exif_type].decode(e, the_data))
+
+
+class JpegParser(object):
+    """A push parser which builds a JpegFile from data fed to it in
+    chunks of any size, for example as it arrives from a socket. Each
+    segment is parsed as soon as all of its data has arrived, and only
+    incomplete segments are buffered. Once the Start-of-Scan segment has
+    been parsed, metadata_complete is set and the image data which follows
+    is only walked to find the EOI marker which ends it, not kept. Anything
+    after the EOI marker becomes a TrailerSegment. The result is like a
+    JpegFile read with headers_only, and can be written out with rewrite()
+    once the whole file has been saved."""
+
+    def __init__(self, mode="ro", lazy=False):
+        self.mode = mode
+        self.lazy = lazy
+        self.segments = []
+        self.buf = bytearray()
+        # File offset of the start of buf
+        self.offset = 0
+        self.state = "soi"
+        # Bytes of a segment between scans still to be skipped
+        self.skip = 0
+        self.trailer = None
+
+    metadata_complete = property(lambda self: self.state in ("image",
+                                                             "trailer"))
+
+    def feed(self, data):
+        """Parse the next chunk of the file. Returns a list of the
+        segments completed by this chunk."""
+        if self.state == "image":
+            self._skip(data)
+            return []
+        if self.state == "trailer":
+            self.trailer.length += len(data)
+            return []
+        self.buf += data
+        new = []
+        while self.state in ("soi", "segments"):
+            buf = self.buf
+            if len(buf) < 2:
+                break
+            if self.state == "soi":
+                if str(buf[:2]) != SOI_MARKER:
+                    raise JpegFile.InvalidFile("Error reading soi_marker. "
+                                               "Got <%s> should be <%s>" %
+                                               (buf[:2], SOI_MARKER))
+                self._consume(2)
+                self.state = "segments"
+                continue
+            if buf[0] != DELIM:
+                raise JpegFile.InvalidFile("Error, expecting delimiter. "
+                                           "Got <%s> should be <%s>" %
+                                           (buf[0], DELIM))
+            mark = buf[1]
+            if mark == EOI:
+                self._consume(2)
+                self._start_trailer()
+                break
+            if len(buf) < 4:
+                break
+            size = unpack_from(">H", buf, 2)[0]
+            if len(buf) < size + 2:
+                break
+            data_offset = self.offset + 4
+            data = str(buf[4:size + 2])
+            self._consume(size + 2)
+            if mark == SOS:
+                segment = StartOfScanSegment(mark, None, data, self.mode,
+                                             headers_only=True)
+                segment.img_offset = self.offset
+                self.state = "image"
+            else:
+                segment = JpegFile._parse_segment(mark, None, data, self.mode,
+                                                  lazy=self.lazy)
+            segment.data_offset = data_offset
+            self.segments.append(segment)
+            new.append(segment)
+        if self.state in ("image", "trailer"):
+            data = str(self.buf)
+            self.buf = bytearray()
+            self.feed(data)
+        return new
+
+    def _consume(self, length):
+        """Discard length bytes from the start of buf."""
+        del self.buf[:length]
+        self.offset += length
+
+    def _start_trailer(self):
+        """Start counting the data after the EOI marker, which is at
+        offset - 2, as a trailer."""
+        self.trailer = TrailerSegment(None, self.mode, headers_only=True)
+        self.trailer.data_offset = self.offset
+        self.trailer.length = 0
+        self.state = "trailer"
+
+    def _skip(self, data):
+        """Walk data from the image data, as index_scans does, looking for
+        the EOI marker. Only the last few bytes are kept in buf, in case
+        they are the start of a marker."""
+        buf = str(self.buf) + str(data)
+        pos = min(self.skip, len(buf))
+        self.skip -= pos
+        while 1:
+            match = SEGMENT_MARKER_RE.search(buf, pos)
+            if match is None:
+                pos = len(buf)
+                if buf.endswith('\xff'):
+                    pos -= 1
+                break
+            pos = match.start()
+            if ord(buf[pos + 1]) == EOI:
+                for segment in self.segments:
+                    if isinstance(segment, StartOfScanSegment):
+                        segment.img_length = \
+                            self.offset + pos - segment.img_offset
+                self.offset += pos + 2
+                self.buf = bytearray()
+                self._start_trailer()
+                self.trailer.length = len(buf) - pos - 2
+                return
+            if pos + 4 > len(buf):
+                break
+            pos += 2 + unpack_from(">H", buf, pos + 2)[0]
+            if pos > len(buf):
+                self.skip = pos - len(buf)
+                pos = len(buf)
+                break
+        self.offset += pos
+        self.buf = bytearray(buf[pos:])
+
+    def get_exif(self):
+        """Return the ExifSegment if it has been parsed, or None."""
+        for segment in self.segments:
+            if isinstance(segment, ExifSegment):
+                return segment
+        return None
+
+    def close(self, filename=None):
+        """Finish parsing, returning a headers_only JpegFile. Raises
+        InvalidFile if the file ended before the EOI marker."""
+        if not self.metadata_complete:
+            raise JpegFile.InvalidFile("Unexpected end of file.")
+        if self.state == "image":
+            raise JpegFile.InvalidFile("Unable to find EOI marker.")
+        jpeg = JpegFile(None, filename, mode=self.mode, headers_only=True)
+        jpeg._segments = list(self.segments)
+        if self.trailer.length:
+            jpeg._segments.append(self.trailer)
+        return jpeg
+
+
+class MetadataRewriter(object):
+    """Copy a JPEG file from the file object src to the file object dst,
+    letting edit change its metadata on the way. Only the segments
+    before the image data are held in memory. Once they have all been
+    read they are parsed into a JpegFile which is passed to edit (for
+    example to call set_geo or remove_metadata). The edited segments are
+    then written to dst, and everything after them is copied through
+    unchanged, chunk_size bytes at a time.
+
+    Call run() to copy all of src. Alternatively src may be None, and the
+    file is written to the MetadataRewriter with write(), followed by
+    close(), so it can be used as the destination of a download."""
+
+    def __init__(self, src, dst, edit, chunk_size=COPY_CHUNK_SIZE):
+        self.src = src
+        self.dst = dst
+        self.edit = edit
+        self.chunk_size = chunk_size
+        self.parser = JpegParser(mode="rw")
+        self.offset = 0
+        self.jpeg = None
+
+    def run(self):
+        """Copy all of src to dst. Returns the edited JpegFile."""
+        while 1:
+            data = self.src.read(self.chunk_size)
+            if not data:
+                break
+            self.write(data)
+        return self.close()
+
+    def write(self, data):
+        """Process the next chunk of the file."""
+        if self.jpeg is not None:
+            self.dst.write(data)
+            return
+        self.parser.feed(data)
+        self.offset += len(data)
+        if not self.parser.metadata_complete:
+            return
+
+        jpeg = JpegFile(None, "stream", mode="rw", headers_only=True)
+        jpeg._segments = self.parser.segments
+        self.edit(jpeg)
+        self.dst.write(SOI_MARKER)
+        start = self.parser.offset
+        for segment in jpeg._segments:
+            if isinstance(segment, StartOfScanSegment):
+                DefaultSegment.write(segment, self.dst)
+                start = segment.img_offset
+                break
+            segment.write(self.dst)
+        else:
+            # No image data, the parser stopped at EOI
+            self.dst.write(EOI_MARKER)
+        self.jpeg = jpeg
+        self.dst.write(data[len(data) - (self.offset - start):])
+
+    def close(self):
+        """Check the whole of the metadata was written, returning the
+        edited JpegFile."""
+        if self.jpeg is None:
+            raise JpegFile.InvalidFile("Unexpected end of file.")
+        return self.jpeg
+
+
+class MetadataCache(object):
+    """A cache of parsed read-only JpegFile objects, keyed by file name
+    and checked against the file's size, modification time and inode on
+    every lookup, so changed files are parsed again. The least recently
+    used entries are discarded to keep within max_entries files and
+    max_bytes bytes of segment data.
+
+    Setting the module global metadata_cache to an instance makes
+    JpegFile.fromFile use it for mode="ro". Cached objects are shared
+    between callers and must not be modified."""
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def file_identity(st):
+        """Return the parts of an os.stat result which identify a
+        version of a file."""
+        return (st.st_size, st.st_mtime, st.st_ino, st.st_dev)
+    file_identity = staticmethod(file_identity)
+
+    def entry_size(jpeg):
+        """Return the number of bytes of file data held by jpeg."""
+        size = 0
+        for segment in jpeg._segments:
+            if segment.data is not None:
+                size += len(segment.data)
+            if isinstance(segment, StartOfScanSegment) and \
+                    segment.img_data is not None:
+                size += segment.img_length
+        return size
+    entry_size = staticmethod(entry_size)
+
+    def load(self, filename, headers_only=False, lazy=False):
+        """Return a read-only JpegFile for the file named filename,
+        parsing it only if it isn't already cached."""
+        key = (os.path.abspath(filename), headers_only, lazy)
+        identity = self.file_identity(os.stat(filename))
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                if entry[0] == identity:
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return entry[1]
+                self.nbytes -= entry[2]
+            self.misses += 1
+
+        with open(filename, "rb") as f:
+            identity = self.file_identity(os.fstat(f.fileno()))
+            jpeg = JpegFile(f, filename=filename, mode="ro",
+                            headers_only=headers_only, lazy=lazy)
+        size = self.entry_size(jpeg)
+        if size > self.max_bytes:
+            return jpeg
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2]
+            self.entries[key] = (identity, jpeg, size)
+            self.nbytes += size
+            while len(self.entries) > self.max_entries or \
+                    self.nbytes > self.max_bytes:
+                _, (_, _, old_size) = self.entries.popitem(last=False)
+                self.nbytes -= old_size
+        return jpeg
+
+    def clear(self):
+        """Discard all cached files."""
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+def extract_fields(filename, fields=None):
+    """Return a dictionary mapping tag names to values for the tags
+    in the primary, Extended EXIF and GPS IFDs of the file named filename.
+    If fields is a list of tag names only those tags are returned, with a
+    value of None for any that are missing. As for JpegFile.read_tags,
+    only the EXIF segment is read and no IFD objects are created."""
+    ifd_classes = (IfdTIFF, IfdExtendedEXIF, IfdGPS)
+    tiff_data, e, tables = read_ifd_tables(filename, ifd_classes)
+    result = {}
+    if fields is not None:
+        for name in fields:
+            result[name] = None
+    try:
+        for ifd_class in ifd_classes:
+            for tag, entry in tables.get(ifd_class, {}).items():
+                if tag in ifd_class.embedded_tags or \
+                        tag not in ifd_class.tags:
+                    continue
+                name = ifd_class.tags[tag][1]
+                if fields is None or (name in fields and
+                                      result[name] is None):
+                    result[name] = read_value(tiff_data, e, *entry)
+    except StructError:
+        raise JpegFile.InvalidFile("Truncated EXIF data in <%s>." %
+                                   filename)
+    return result
+
+
+def extract_thumbnail(fd):
+    """Return the JPEG data of the EXIF thumbnail of the JPEG file object
+    fd as a buffer, or None if it doesn't have one. Only the EXIF segment
+    is read, and only the entry tables of the first two IFDs are decoded.
+    For a MappedFile (see JpegFile.fromFile) the buffer refers directly to
+    the mapped memory."""
+    found = find_exif(fd)
+    if found is None:
+        return None
+    fd.seek(found[0])
+    tiff_data, e = exif_tiff_data(fd.read(found[1]))
+    try:
+        offset = unpack_from(e + "I", tiff_data, 4)[0]
+        num_entries = get_struct(e + "H").unpack_from(tiff_data, offset)[0]
+        offset += 2 + num_entries * 12
+        offset = get_struct(e + "I").unpack_from(tiff_data, offset)[0]
+        if not offset:
+            return None
+        table = read_ifd_table(tiff_data, e, offset)
+        if 0x201 not in table or 0x202 not in table:
+            return None
+        offset = read_value(tiff_data, e, *table[0x201])[0]
+        size = read_value(tiff_data, e, *table[0x202])[0]
+    except StructError:
+        raise JpegFile.InvalidFile("Truncated EXIF data.")
+    if offset + size > len(tiff_data):
+        raise JpegFile.InvalidFile("Not enough data for JPEG thumbnail.")
+    return buffer(tiff_data, offset, size)
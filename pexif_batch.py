@@ -0,0 +1,292 @@
+"""
+pexif_batch reads and edits many JPEG files at once, using pexif on a
+pool of worker processes (or threads, for work which is mostly I/O). It is
+kept apart from pexif, which only parses and writes single files, so that
+importing pexif doesn't bring in multiprocessing or install signal
+handlers.
+
+batch_extract, batch_extract_thumbnails and batch_edit process a set of
+files, yielding a result for each in order, and BackgroundIO runs pexif
+operations on a pool of threads for programs driven by an event loop.
+"""
+
+import collections
+import datetime
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import signal
+import sys
+
+from pexif import JpegFile, IfdTIFF, IfdExtendedEXIF, IfdGPS, EXIF_OFFSET, \
+    extract_fields, extract_thumbnail
+
+# File name extensions of JPEG files, used when walking directory trees
+JPEG_EXTENSIONS = (".jpg", ".jpeg", ".jpe")
+
+
+class BatchError(Exception):
+    """The result, returned rather than raised, for a file which couldn't
+    be processed by one of the batch functions. Exceptions aren't
+    returned as is, as not all of them can be pickled."""
+    pass
+
+
+def _extract_fields_worker(filename, fields):
+    """Run extract_fields in a worker process. Any exception is caught,
+    as damaged files raise all sorts, and one mustn't stop the rest of
+    the batch."""
+    try:
+        return extract_fields(filename, fields)
+    except Exception:
+        type, value, traceback = sys.exc_info()
+        return BatchError("Error reading %s: %s" % (filename, value))
+
+
+# Waiting for a result without a timeout can't be interrupted
+BATCH_TIMEOUT = 365 * 24 * 60 * 60
+
+
+def batch(worker, filenames, args, workers, pool_class=multiprocessing.Pool,
+          initializer=None):
+    """Call worker(filename, *args) for each of filenames in a pool of
+    worker processes (or pool_class), yielding (filename, result) tuples
+    in order. At most a few files per worker are in flight at any time.
+    initializer is called in each worker when it starts. This is the
+    basis of the other batch functions; worker should catch any exception
+    and return a BatchError instead, so one file can't stop the batch."""
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    pool = pool_class(workers, initializer)
+    pending = collections.deque()
+    try:
+        for filename in filenames:
+            result = pool.apply_async(worker, (filename,) + args)
+            pending.append((filename, result))
+            if len(pending) >= workers * 4:
+                filename, result = pending.popleft()
+                yield filename, result.get(BATCH_TIMEOUT)
+        while pending:
+            filename, result = pending.popleft()
+            yield filename, result.get(BATCH_TIMEOUT)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def batch_extract(filenames, fields=None, workers=None):
+    """Extract tags from many files in parallel using a pool of worker
+    processes. This is a generator which yields (filename, result) tuples
+    in the same order as filenames, where result is the dictionary returned
+    by extract_fields, or a BatchError if the file couldn't be read.
+    workers defaults to the number of CPUs, and at most a few files per
+    worker are in flight at any time, so filenames may be a lazy iterable
+    of any length."""
+    return batch(_extract_fields_worker, filenames, (fields,), workers)
+
+
+TIME_FORMAT = "%Y:%m:%d %H:%M:%S"
+TIME_TAGS = ("DateTime", "DateTimeOriginal", "DateTimeDigitized")
+
+
+def field_ifd(primary, name):
+    """Return the IFD in which the tag named name belongs, out of the
+    primary IFD primary and its Extended EXIF and GPS IFDs, creating the
+    embedded IFD if necessary. Raises KeyError for an unknown name."""
+    if name in IfdTIFF.tag_names:
+        return primary
+    if name in IfdExtendedEXIF.tag_names:
+        return primary.ExtendedEXIF
+    if name in IfdGPS.tag_names:
+        return primary.GPS
+    raise KeyError(name)
+
+
+def edit_metadata(jf, edit):
+    """Apply edit to the JpegFile jf, which must be in "rw" mode. edit is a
+    dictionary which may contain:
+
+    "strip": if true, remove all metadata segments, as remove_metadata.
+    "geo": a (lat, lng) tuple, as for set_geo.
+    "shift": a timedelta added to each of TIME_TAGS that is set.
+    Files without EXIF data are left alone.
+    "fields": a dictionary mapping tag names, in the primary, Extended EXIF
+    or GPS IFDs, to values, as returned by extract_fields. A value of None
+    removes the tag.
+
+    The edits are applied in that order."""
+    if edit.get("strip"):
+        jf.remove_metadata(paranoid=True)
+    if edit.get("geo") is not None:
+        jf.set_geo(*edit["geo"])
+    exif = jf.get_exif()
+    primary = exif and exif.get_primary()
+    if edit.get("shift") and primary is not None:
+        for ifd in (primary, primary[EXIF_OFFSET]):
+            for name in TIME_TAGS:
+                if ifd is not None and name in ifd.tag_names and ifd[name]:
+                    value = datetime.datetime.strptime(ifd[name], TIME_FORMAT)
+                    ifd[name] = (value + edit["shift"]).strftime(TIME_FORMAT)
+    for name, value in edit.get("fields", {}).items():
+        ifd = field_ifd(jf.exif.primary, name)
+        if value is None:
+            del ifd[name]
+        else:
+            ifd[name] = value
+
+
+def edit_file(filename, edit, sync=True):
+    """Apply edit, as for edit_metadata, to the JPEG file named filename
+    and return the size of the new file. Only the headers are parsed, and
+    the file is replaced atomically, see rewrite; with sync the new file
+    is on disk before it replaces the old one."""
+    jf = JpegFile.fromFile(filename, headers_only=True)
+    edit_metadata(jf, edit)
+    jf.rewrite(filename, filename, sync)
+    return os.path.getsize(filename)
+
+
+def _edit_file_worker(filename, edit, sync):
+    """Run edit_file in a worker process, returning a BatchError if it
+    fails for any reason."""
+    try:
+        return edit_file(filename, edit, sync)
+    except Exception:
+        type, value, traceback = sys.exc_info()
+        return BatchError("Error editing %s: %s" % (filename, value))
+
+
+def _edit_worker_init():
+    """Set up a batch_edit worker process. Interrupts are left to the
+    parent, which terminates the pool, and termination raises SystemExit
+    so that rewrite removes its temporary file on the way out."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+
+
+def _exit_on_signal(signum, frame):
+    sys.exit(1)
+
+
+def batch_edit(filenames, edit, workers=None, sync=True):
+    """Apply edit to many files in parallel using a pool of worker
+    processes, as for batch_extract. This is a generator which yields
+    (filename, result) tuples in the same order as filenames, where result
+    is the size of the new file as returned by edit_file, or a BatchError
+    if the file couldn't be edited, in which case it is left unchanged.
+    Files being written when the batch is abandoned are left unchanged
+    too."""
+    return batch(_edit_file_worker, filenames, (edit, sync), workers,
+                  initializer=_edit_worker_init)
+
+
+def _thumbnail_worker(filename):
+    """Return the thumbnail of the file named filename as a string, or a
+    BatchError if it can't be read."""
+    try:
+        with open(filename, "rb") as f:
+            thumbnail = extract_thumbnail(f)
+    except Exception:
+        type, value, traceback = sys.exc_info()
+        return BatchError("Error reading %s: %s" % (filename, value))
+    if thumbnail is not None:
+        thumbnail = str(thumbnail)
+    return thumbnail
+
+
+def batch_extract_thumbnails(filenames, workers=8):
+    """Extract the EXIF thumbnails of many files using a pool of threads,
+    as the work is almost all I/O. This is a generator which yields
+    (filename, result) tuples in the same order as filenames, where result
+    is the JPEG data of the thumbnail, None if the file has no thumbnail,
+    or a BatchError if the file couldn't be read."""
+    return batch(_thumbnail_worker, filenames, (), workers, ThreadPool)
+
+
+class BackgroundIO(object):
+    """Reads and writes JPEG files on a pool of threads, so that
+    programs driven by an event loop aren't blocked by disk I/O. Each
+    method returns a multiprocessing AsyncResult. If callback is given it
+    is called from a pool thread as callback(result, None) on success or
+    callback(None, exception) on failure. At most workers operations run
+    at once and the rest are queued."""
+
+    def __init__(self, workers=4):
+        self.pool = ThreadPool(workers)
+
+    def _call(func, args, kwargs, callback):
+        """Run func in a pool thread, reporting the outcome to callback."""
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            if callback is not None:
+                callback(None, sys.exc_info()[1])
+            raise
+        if callback is not None:
+            callback(result, None)
+        return result
+    _call = staticmethod(_call)
+
+    def _submit(self, func, args, kwargs={}, callback=None):
+        return self.pool.apply_async(self._call,
+                                     (func, args, kwargs, callback))
+
+    def fromFile(self, filename, mode="rw", headers_only=True, lazy=True,
+                 callback=None):
+        """Read the file named filename as JpegFile.fromFile would. By
+        default only the headers are read, so the result should be
+        written out with rewrite()."""
+        return self._submit(JpegFile.fromFile, (filename,),
+                            {"mode": mode, "headers_only": headers_only,
+                             "lazy": lazy}, callback)
+
+    def rewrite(self, jpeg, src_path, dst_path, callback=None):
+        """Write jpeg out to dst_path as jpeg.rewrite would."""
+        return self._submit(jpeg.rewrite, (src_path, dst_path),
+                            callback=callback)
+
+    def writeFile(self, jpeg, filename, callback=None):
+        """Write jpeg, which must hold its image data, to filename."""
+        return self._submit(jpeg.writeFile, (filename,), callback=callback)
+
+    def extract(self, filenames, fields=None, workers=None, callback=None):
+        """Extract tags from many files using batch_extract, which parses
+        them in worker processes. Unlike the other methods, callback is
+        called for each (filename, result) tuple as soon as it arrives,
+        as callback((filename, result), None), and with callback(None,
+        exception) if the batch itself fails. The AsyncResult completes
+        with the number of files once all of them have been delivered.
+        Results aren't accumulated, so filenames may be a lazy iterable
+        of any length."""
+        def run():
+            count = 0
+            for item in batch_extract(filenames, fields, workers):
+                if callback is not None:
+                    callback(item, None)
+                count += 1
+            return count
+
+        def failed(result, error):
+            if error is not None and callback is not None:
+                callback(None, error)
+        return self._submit(run, (), callback=failed)
+
+    def close(self):
+        """Wait for queued operations to finish and stop the threads."""
+        self.pool.close()
+        self.pool.join()
+
+
+def find_files(args):
+    """Yield the names of the files in args, a list of file and directory
+    names, replacing each directory with the JPEG files in its tree, in
+    order."""
+    for arg in args:
+        if not os.path.isdir(arg):
+            yield arg
+            continue
+        for dirpath, dirnames, filenames in os.walk(arg):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.lower().endswith(JPEG_EXTENSIONS):
+                    yield os.path.join(dirpath, name)
@@ -0,0 +1,173 @@
+"""
+pexif_index keeps an SQLite index of the EXIF tags of a tree of JPEG
+files, which can be searched by camera, date and location. It is kept
+apart from pexif so that pexif can be used without the sqlite3 module.
+
+update_index brings an index up to date with a directory tree, parsing
+only new and changed files, and query_index searches it.
+"""
+
+import os
+import sqlite3
+import sys
+
+from pexif import JpegFile
+from pexif_batch import BatchError, JPEG_EXTENSIONS, batch
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS photos (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    make TEXT,
+    model TEXT,
+    date_time TEXT,
+    latitude REAL,
+    longitude REAL,
+    width INTEGER,
+    height INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS photos_date_time ON photos (date_time);
+CREATE INDEX IF NOT EXISTS photos_camera ON photos (make, model);
+CREATE INDEX IF NOT EXISTS photos_location ON photos (latitude, longitude);
+"""
+
+# Number of files parsed between commits in update_index
+INDEX_COMMIT_ROWS = 1000
+
+def index_record(filename):
+    """Return the tuple (make, model, date_time, latitude, longitude,
+    width, height) stored by update_index for the file named filename.
+    Values which the file doesn't have are None."""
+    jf = JpegFile.fromFile(filename, mode="ro", headers_only=True, lazy=True)
+    make = model = date_time = None
+    exif = jf.get_exif()
+    primary = exif and exif.get_primary()
+    if primary is not None:
+        make, model = primary["Make"], primary["Model"]
+        if primary["ExtendedEXIF"] is not None:
+            date_time = primary["ExtendedEXIF"]["DateTimeOriginal"]
+    try:
+        latitude, longitude = jf.get_geo()
+    except (AttributeError, JpegFile.NoSection, ZeroDivisionError):
+        latitude = longitude = None
+    width, height = jf.get_dimensions() or (None, None)
+    return (make, model, date_time, latitude, longitude, width, height)
+
+
+def _index_worker(filename):
+    """Run index_record in a worker process, returning a BatchError if it
+    fails for any reason."""
+    try:
+        return index_record(filename)
+    except Exception:
+        type, value, traceback = sys.exc_info()
+        return BatchError("Error reading %s: %s" % (filename, value))
+
+
+def update_index(db_path, root, workers=None):
+    """Bring the SQLite index in the file db_path up to date with the
+    JPEG files in the directory tree root. Only files which are new, or
+    whose size or modification time has changed, are parsed (in parallel
+    as for batch_extract). Files which have been removed are dropped from
+    the index. Returns a tuple of the number of files (updated, removed).
+    Files which can't be read are recorded with an error, so they aren't
+    parsed again until they change. Rows are committed every
+    INDEX_COMMIT_ROWS files, so an interrupted update keeps most of its
+    work."""
+    root = os.path.abspath(root)
+    db = sqlite3.connect(db_path)
+    db.text_factory = str
+    try:
+        db.executescript(INDEX_SCHEMA)
+        known = {}
+        prefix = os.path.join(root, "")
+        for path, size, mtime in db.execute(
+                "SELECT path, size, mtime FROM photos"):
+            if path.startswith(prefix):
+                known[path] = (size, mtime)
+
+        stats = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in filenames:
+                if not name.lower().endswith(JPEG_EXTENSIONS):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                stats[path] = (st.st_size, st.st_mtime)
+        changed = sorted(path for path in stats
+                         if known.get(path) != stats[path])
+        removed = [(path,) for path in known if path not in stats]
+
+        with db:
+            db.executemany("DELETE FROM photos WHERE path = ?", removed)
+
+        updated = 0
+        rows = []
+        results = []
+        if changed:
+            results = batch(_index_worker, changed, (), workers)
+        for path, result in results:
+            if isinstance(result, BatchError):
+                result = (None,) * 7 + (str(result),)
+            else:
+                result += (None,)
+            rows.append((path,) + stats[path] + result)
+            if len(rows) >= INDEX_COMMIT_ROWS:
+                updated += _insert_rows(db, rows)
+                rows = []
+        updated += _insert_rows(db, rows)
+        return updated, len(removed)
+    finally:
+        db.close()
+
+
+def _insert_rows(db, rows):
+    """Add or replace rows in the photos table of db, committing them,
+    and return the number of rows."""
+    with db:
+        db.executemany("INSERT OR REPLACE INTO photos VALUES "
+                       "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    return len(rows)
+
+
+def query_index(db_path, bbox=None, make=None, model=None, start=None,
+                end=None):
+    """Return the paths of the files in the SQLite index db_path which
+    match all of the given conditions, in order of the date they were
+    taken. bbox is a tuple (min_latitude, min_longitude, max_latitude,
+    max_longitude). start and end are EXIF date strings
+    ("YYYY:MM:DD HH:MM:SS"), or prefixes of them, and are inclusive."""
+    conditions = []
+    args = []
+    if bbox is not None:
+        conditions.append("latitude BETWEEN ? AND ? AND "
+                          "longitude BETWEEN ? AND ?")
+        args += [bbox[0], bbox[2], bbox[1], bbox[3]]
+    if make is not None:
+        conditions.append("make = ?")
+        args.append(make)
+    if model is not None:
+        conditions.append("model = ?")
+        args.append(model)
+    if start is not None:
+        conditions.append("date_time >= ?")
+        args.append(start)
+    if end is not None:
+        # Make a date prefix include the whole of that period
+        conditions.append("date_time <= ?")
+        args.append(end + "\xff")
+    sql = "SELECT path FROM photos"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY date_time, path"
+    db = sqlite3.connect(db_path)
+    db.text_factory = str
+    try:
+        return [path for path, in db.execute(sql, args)]
+    finally:
+        db.close()
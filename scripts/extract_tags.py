@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+"""
+Print EXIF tags from many JPEG files, reading the files in parallel.
+"""
+
+import sys
+from pexif_batch import batch_extract, BatchError
+from optparse import OptionParser
+
+
+def parse_args():
+    p = OptionParser(usage='%prog [-j workers] [-f tag,...] file.jpg...',
+           description='prints EXIF tags from many files in parallel')
+    p.add_option('-j', '--jobs', type='int', default=None,
+                 help='number of worker processes (default: number of CPUs)')
+    p.add_option('-f', '--fields', default=None,
+                 help='comma separated list of tags to print (default: all)')
+    options, args = p.parse_args()
+    if len(args) < 1:
+        p.error('not enough arguments')
+    fields = None
+    if options.fields:
+        fields = options.fields.split(',')
+    return options.jobs, fields, args
+
+
+def main():
+    jobs, fields, files = parse_args()
+    status = 0
+
+    for fname, result in batch_extract(files, fields, jobs):
+        if isinstance(result, BatchError):
+            print >> sys.stderr, result
+            status = 1
+            continue
+        for name in sorted(result):
+            print "%s: %-30s %s" % (fname, name, result[name])
+
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
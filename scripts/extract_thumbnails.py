@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+"""
+Save the thumbnails embedded in the EXIF data of JPEG files, without
+decoding or fully parsing the files.
+"""
+
+import os
+import sys
+from pexif_batch import batch_extract_thumbnails, BatchError, find_files
+from optparse import OptionParser
+
+
+def parse_args():
+    p = OptionParser(usage='%prog [-j threads] [-d directory] file.jpg|dir...',
+           description='saves the EXIF thumbnail of each file (or each '
+                       'JPEG file in a directory tree) as NAME_thumb.jpg')
+    p.add_option('-j', '--jobs', type='int', default=8,
+                 help='number of threads (default: 8)')
+    p.add_option('-d', '--directory', default='.',
+                 help='directory to save the thumbnails in (default: .)')
+    options, args = p.parse_args()
+    if len(args) < 1:
+        p.error('not enough arguments')
+    return options.jobs, options.directory, args
+
+
+def main():
+    jobs, directory, args = parse_args()
+    status = 0
+
+    for fname, result in batch_extract_thumbnails(find_files(args), jobs):
+        if isinstance(result, BatchError):
+            print >> sys.stderr, result
+            status = 1
+        elif result is None:
+            print >> sys.stderr, "%s: no thumbnail" % fname
+        else:
+            name = os.path.splitext(os.path.basename(fname))[0]
+            path = os.path.join(directory, name + "_thumb.jpg")
+            with open(path, "wb") as f:
+                f.write(result)
+            print path
+
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,7 +10,7 @@ if len(sys.argv) != 3:
     sys.exit(1)
 
 try:
-    ef = JpegFile.fromFile(sys.argv[1])
+    ef = JpegFile.fromFile(sys.argv[1], headers_only=True)
 except IOError:
     type, value, traceback = sys.exc_info()
     print >> sys.stderr, "Error opening file:", value
@@ -21,7 +21,7 @@ except JpegFile.InvalidFile:
     sys.exit(1)
 
 try:
-    ef.writeFile(sys.argv[2])
+    ef.rewrite(sys.argv[1], sys.argv[2])
 except IOError:
     type, value, traceback = sys.exc_info()
     print >> sys.stderr, "Error saving file:", value
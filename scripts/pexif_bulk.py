@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+Apply the same metadata edit to every JPEG file in a set of files and
+directory trees, using several worker processes. Each file is written to a
+temporary file which replaces it only once complete, so an interrupted run
+never leaves a half written file.
+"""
+
+import sys
+import time
+from datetime import timedelta
+from pexif import extract_fields, JpegFile, IfdTIFF, IfdExtendedEXIF, \
+    IfdGPS, ASCII
+from pexif_batch import batch_edit, BatchError, find_files
+from optparse import OptionParser
+
+
+def parse_args():
+    p = OptionParser(usage='%prog [options] file.jpg|dir...',
+           description='edits the metadata of each file (or each JPEG '
+                       'file in a directory tree) in place')
+    p.add_option('-j', '--jobs', type='int', default=None,
+                 help='number of worker processes (default: number of CPUs)')
+    p.add_option('-g', '--gps', default=None,
+                 help='set the GPS location to LAT,LNG')
+    p.add_option('-t', '--shift-hours', type='int', default=None,
+                 help='adjust the timestamps by SHIFT_HOURS hours')
+    p.add_option('-r', '--strip', action='store_true', default=False,
+                 help='remove all metadata before any other edit')
+    p.add_option('-s', '--set', action='append', default=[],
+                 metavar='NAME=VALUE',
+                 help='set the text tag NAME to VALUE (may be repeated)')
+    p.add_option('-c', '--copy-from', default=None, metavar='FILE',
+                 help='copy the tags listed with --fields from FILE')
+    p.add_option('-f', '--fields', default=None,
+                 help='comma separated names of the tags to copy')
+    p.add_option('--no-sync', action='store_true', default=False,
+                 help="don't wait for each file to reach the disk")
+    p.add_option('-q', '--quiet', action='store_true', default=False,
+                 help='only report errors and the summary')
+    options, args = p.parse_args()
+    if len(args) < 1:
+        p.error('not enough arguments')
+
+    edit = {"strip": options.strip, "fields": {}}
+    if options.gps:
+        try:
+            lat, lng = [float(x) for x in options.gps.split(',')]
+        except ValueError:
+            p.error('gps must be two comma separated numbers')
+        edit["geo"] = (lat, lng)
+    if options.shift_hours:
+        edit["shift"] = timedelta(hours=options.shift_hours)
+    if (options.copy_from is None) != (options.fields is None):
+        p.error('--copy-from and --fields must be used together')
+    if options.copy_from:
+        try:
+            edit["fields"].update(extract_fields(options.copy_from,
+                                                 options.fields.split(',')))
+        except (IOError, JpegFile.InvalidFile):
+            type, value, traceback = sys.exc_info()
+            p.error('error reading %s: %s' % (options.copy_from, value))
+    for setting in options.set:
+        name, sep, value = setting.partition('=')
+        for ifd_class in (IfdTIFF, IfdExtendedEXIF, IfdGPS):
+            if name in ifd_class.tag_names:
+                tag = ifd_class.tag_names[name]
+                break
+        else:
+            p.error('unknown tag %s' % name)
+        if not sep or ifd_class.tags[tag][2] != ASCII:
+            p.error('--set only supports NAME=VALUE for text tags')
+        edit["fields"][name] = value
+    if not (edit["strip"] or edit["fields"] or "geo" in edit or
+            "shift" in edit):
+        p.error('no edit given')
+    return options, edit, args
+
+
+def main():
+    options, edit, args = parse_args()
+    start = time.time()
+    done = failed = size = 0
+
+    status = 0
+    try:
+        for fname, result in batch_edit(find_files(args), edit, options.jobs,
+                                        not options.no_sync):
+            if isinstance(result, BatchError):
+                print >> sys.stderr, result
+                failed += 1
+                continue
+            done += 1
+            size += result
+            if not options.quiet:
+                print >> sys.stderr, "[%d] %s" % (done + failed, fname)
+    except KeyboardInterrupt:
+        print >> sys.stderr, "Interrupted, remaining files are unchanged"
+        status = 1
+
+    elapsed = time.time() - start
+    print >> sys.stderr, "%d files edited, %d failed, %.1f MB written " \
+        "in %.1fs" % (done, failed, size / 1e6, elapsed)
+    return 1 if failed else status
+
+if __name__ == "__main__":
+    sys.exit(main())
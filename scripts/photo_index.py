@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+"""
+Keep an SQLite index of the EXIF tags of a tree of JPEG files, and search
+it by camera, date and location.
+"""
+
+import sys
+from pexif_index import update_index, query_index
+from optparse import OptionParser
+
+
+def parse_args():
+    p = OptionParser(usage='%prog [options] index.db [directory...]',
+           description='updates the index with the files in each directory, '
+                       'then prints the indexed files matching the options')
+    p.add_option('-j', '--jobs', type='int', default=None,
+                 help='number of worker processes (default: number of CPUs)')
+    p.add_option('-b', '--bbox', default=None,
+                 help='only files within min_lat,min_lng,max_lat,max_lng')
+    p.add_option('-m', '--make', default=None,
+                 help='only files from cameras made by MAKE')
+    p.add_option('-M', '--model', default=None,
+                 help='only files from cameras of model MODEL')
+    p.add_option('-s', '--start', default=None,
+                 help='only files taken on or after START (YYYY:MM:DD)')
+    p.add_option('-e', '--end', default=None,
+                 help='only files taken on or before END (YYYY:MM:DD)')
+    p.add_option('-q', '--quiet', action='store_true', default=False,
+                 help='update the index without printing any files')
+    options, args = p.parse_args()
+    if len(args) < 1:
+        p.error('not enough arguments')
+    if options.bbox:
+        try:
+            options.bbox = [float(x) for x in options.bbox.split(',')]
+        except ValueError:
+            options.bbox = []
+        if len(options.bbox) != 4:
+            p.error('bbox must be four comma separated numbers')
+    return options, args[0], args[1:]
+
+
+def main():
+    options, db_path, directories = parse_args()
+
+    for directory in directories:
+        updated, removed = update_index(db_path, directory, options.jobs)
+        print >> sys.stderr, "%s: %d updated, %d removed" % \
+            (directory, updated, removed)
+
+    if not options.quiet:
+        for path in query_index(db_path, options.bbox, options.make,
+                                options.model, options.start, options.end):
+            print path
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,12 @@ import sys
 
 usage = """Usage: remove_metadata.py filename.jpg"""
 
-if len(sys.argv) != 4:
+if len(sys.argv) != 2:
     print >> sys.stderr, usage
     sys.exit(1)
 
 try:
-    ef = JpegFile.fromFile(sys.argv[1])
+    ef = JpegFile.fromFile(sys.argv[1], headers_only=True)
     ef.remove_metadata(paranoid=True)
 except IOError:
     type, value, traceback = sys.exc_info()
@@ -19,7 +19,7 @@ except JpegFile.InvalidFile:
     print >> sys.stderr, "Error opening file:", value
 
 try:
-    ef.writeFile(sys.argv[1])
+    ef.rewrite(sys.argv[1], sys.argv[1])
 except IOError:
     type, value, traceback = sys.exc_info()
     print >> sys.stderr, "Error saving file:", value
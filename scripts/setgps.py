@@ -9,7 +9,7 @@ if len(sys.argv) != 4:
     sys.exit(1)
 
 try:
-    ef = JpegFile.fromFile(sys.argv[1])
+    ef = JpegFile.fromFile(sys.argv[1], headers_only=True)
     ef.set_geo(float(sys.argv[2]), float(sys.argv[3]))
 except IOError:
     type, value, traceback = sys.exc_info()
@@ -19,7 +19,7 @@ except JpegFile.InvalidFile:
     print >> sys.stderr, "Error opening file:", value
 
 try:
-    ef.writeFile(sys.argv[1])
+    ef.rewrite(sys.argv[1], sys.argv[1])
 except IOError:
     type, value, traceback = sys.exc_info()
     print >> sys.stderr, "Error saving file:", value
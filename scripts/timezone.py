@@ -49,7 +49,7 @@ def main():
 
     for fname in files:
         try:
-            jf = JpegFile.fromFile(fname)
+            jf = JpegFile.fromFile(fname, headers_only=True)
         except (IOError, JpegFile.InvalidFile):
             type, value, traceback = sys.exc_info()
             print >> sys.stderr, "Error reading %s:" % fname, value
@@ -65,7 +65,7 @@ def main():
         adjust_time(primary, delta)
 
         try:
-            jf.writeFile(fname)
+            jf.patch_in_place(fname)
         except IOError:
             type, value, traceback = sys.exc_info()
             print >> sys.stderr, "Error saving %s:" % fname, value
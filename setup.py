@@ -15,9 +15,11 @@ setup (
     author_email = "benno@benno.id.au",
     url = "http://www.benno.id.au/code/pexif/",
     license = "http://www.opensource.org/licenses/mit-license.php",
-    py_modules = ["pexif"],
+    py_modules = ["pexif", "pexif_batch", "pexif_index"],
     scripts = ["scripts/dump_exif.py", "scripts/setgps.py", "scripts/getgps.py", "scripts/noop.py",
-               "scripts/timezone.py", "scripts/remove_metadata.py"],
+               "scripts/timezone.py", "scripts/remove_metadata.py",
+               "scripts/extract_tags.py", "scripts/photo_index.py",
+               "scripts/extract_thumbnails.py", "scripts/pexif_bulk.py"],
     platforms = ["any"],
     classifiers = ["Development Status :: 4 - Beta",
                    "Intended Audience :: Developers",
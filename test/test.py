@@ -1,7 +1,18 @@
 import unittest
 import pexif
+import pexif_batch
+import pexif_index
 import StringIO
+import datetime
 import difflib
+import io
+import multiprocessing
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+import time
 
 test_data = [
     ("test/data/rose.jpg", "test/data/rose.txt"),
@@ -221,6 +232,36 @@ class TestExifFunctions(unittest.TestCase):
         ext_exif = pexif.IfdExtendedEXIF(jf.exif.primary.e, 0, "rw", jf)
         jf.exif.primary.ExtendedEXIF = ext_exif
 
+    def test_tag_names(self):
+        self.assertEqual(pexif.IfdTIFF.tag_names["Make"], 0x10f)
+        self.assertEqual(pexif.IfdThumbnail.tag_names["Make"], 0x10f)
+        self.assertEqual(pexif.IfdTIFF.embedded_names["GPS"],
+                         (0x8825, pexif.IfdGPS))
+        self.assertFalse("MakerNote" in pexif.IfdExtendedEXIF.embedded_names)
+
+    def test_entry_index(self):
+        primary = pexif.JpegFile.fromFile(DEFAULT_TESTFILE).exif.primary
+        primary.Artist = "Me"
+        self.assertEqual(primary.entries[primary.entry_index(0x13B)][2], "Me\0")
+        del primary.Make
+        self.assertEqual(primary.Artist, "Me")
+        self.assertEqual(primary["Make"], None)
+        # Modifying entries directly is still picked up
+        primary.entries.insert(0, (0x10f, pexif.ASCII, "Other\0"))
+        self.assertEqual(primary.Make, "Other")
+        self.assertEqual(primary.Artist, "Me")
+
+    def test_getdata(self):
+        # getdata gives the same bytes as the segment serializer
+        for test_file, _ in test_data[:2]:
+            exif = pexif.JpegFile.fromFile(test_file).exif
+            data = exif.get_data()
+            primary = exif.primary
+            ifd_data, next_offset = primary.getdata(exif.e, 8)
+            self.assertEqual(next_offset, 8 + len(ifd_data))
+            self.assertEqual(data[14:14 + len(ifd_data) - 4],
+                             ifd_data[:-4])
+
     def test_set_xy_dimensions(self):
         """Test setting PixelXDimension and PixelYDimension."""
         jf = pexif.JpegFile.fromFile(DEFAULT_TESTFILE)
@@ -232,5 +273,1088 @@ class TestExifFunctions(unittest.TestCase):
         self.assertEqual(nf.exif.primary.ExtendedEXIF.PixelYDimension, [1200])
 
 
+class CountingFile(StringIO.StringIO):
+    """A file object over a string which counts the bytes read."""
+
+    def __init__(self, data):
+        StringIO.StringIO.__init__(self, data)
+        self.nbytes = 0
+
+    def read(self, size=-1):
+        data = StringIO.StringIO.read(self, size)
+        self.nbytes += len(data)
+        return data
+
+
+class TestHeadersOnly(unittest.TestCase):
+
+    def test_dump(self):
+        # Header only parsing should dump exactly the same as a full parse
+        for test_file, expected_file in test_data:
+            expected = open(expected_file, 'rb').read()
+            jpeg = pexif.JpegFile.fromFile(test_file, mode="ro",
+                                           headers_only=True)
+            out = StringIO.StringIO()
+            jpeg.dump(out)
+            self.assertEqual(expected, out.getvalue())
+
+    def test_no_image_data(self):
+        jf = pexif.JpegFile.fromFile(DEFAULT_TESTFILE, headers_only=True)
+        self.assertEqual(jf.get_exif().get_primary().Make, "Canon")
+        sos = jf._segments[-1]
+        self.assertEqual(sos.img_data, None)
+        self.assertEqual(sos.img_length, 4023)
+        self.assertRaises(pexif.JpegFile.NoImageData, jf.writeString)
+
+    def test_dimensions(self):
+        jf = pexif.JpegFile.fromFile(DEFAULT_TESTFILE, headers_only=True)
+        self.assertEqual(jf.get_dimensions(), (205, 154))
+        jf.remove_metadata(paranoid=True)
+        jf._segments = [seg for seg in jf._segments if seg.code != "SOF2"]
+        self.assertEqual(jf.get_dimensions(), None)
+
+    def test_trailing_data(self):
+        data = open(DEFAULT_TESTFILE, "rb").read() + "trailer"
+        jf = pexif.JpegFile.fromString(data, headers_only=True)
+        # The trailer is found along with the end of the image data
+        self.assertEqual(jf._segments[-1].img_length, 4023)
+        self.assertEqual(jf._segments[-1].length, len("trailer"))
+
+    def test_reads_headers_only(self):
+        data = open(DEFAULT_TESTFILE, "rb").read()
+        sos = pexif.JpegFile.fromString(data)._segments[-1]
+        image = "\x12" * (1 << 20)
+        data = data[:sos.img_offset] + image + pexif.EOI_MARKER + "trailer"
+        f = CountingFile(data)
+        jf = pexif.JpegFile(f, "counted", headers_only=True)
+        self.assertEqual(jf.exif.primary.Make, "Canon")
+        self.assertEqual(f.nbytes, sos.img_offset)
+        sos = jf._segments[-1]
+        self.assertEqual(sos.img_offset, len(data) - len(image) - 9)
+        # The image data and trailer are read when first needed
+        self.assertEqual(sos.img_length, len(image))
+        self.assertEqual(jf._segments[-1].length, len("trailer"))
+        self.assertTrue(f.nbytes >= len(image))
+
+    def test_reopened(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "trailer.jpg")
+            shutil.copy(DEFAULT_TESTFILE, path)
+            with open(path, "ab") as f:
+                f.write("trailer")
+            jf = pexif.JpegFile.fromFile(path, headers_only=True)
+            out = StringIO.StringIO()
+            jf.dump(out)
+            self.assertTrue(out.getvalue().endswith(
+                " Section: [Trail] Size:      7\n"))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_malformed_image_data(self):
+        # Image data which can't be walked falls back to the last EOI
+        # marker, found without reading the whole file again
+        data = open(DEFAULT_TESTFILE, "rb").read()
+        sos = pexif.JpegFile.fromString(data)._segments[-1]
+        image = "\x12" * (1 << 20) + "\xff\xc4\xff\xff" + "\x12" * 10
+        data = data[:sos.img_offset] + image + pexif.EOI_MARKER
+        f = CountingFile(data)
+        jf = pexif.JpegFile(f, "counted", headers_only=True)
+        self.assertEqual(jf._segments[-1].img_length, len(image))
+        self.assertTrue(f.nbytes <= len(data) + pexif.COPY_CHUNK_SIZE)
+
+
+class TestTrailer(unittest.TestCase):
+
+    def setUp(self):
+        self.data = open(DEFAULT_TESTFILE, "rb").read()
+        self.trailer = "\xff\xd8 second image \xff\xd9"
+
+    def test_find_eoi(self):
+        # Stuffed bytes, fill bytes and RST markers don't end the scan
+        scan = "\x12\xff\x00\x34\xff\xd0\x56\xff\xff\xd7"
+        self.assertEqual(pexif.find_eoi(scan + pexif.EOI_MARKER), len(scan))
+        # Segments between scans are skipped, even if they contain EOI
+        dht = "\xff\xc4\x00\x04\xff\xd9"
+        self.assertEqual(pexif.find_eoi(dht + scan + pexif.EOI_MARKER),
+                         len(dht + scan))
+        self.assertEqual(pexif.find_eoi(scan), -1)
+
+    def test_regen(self):
+        data = self.data + self.trailer
+        jf = pexif.JpegFile.fromString(data)
+        trailer = jf._segments[-1]
+        self.assertTrue(isinstance(trailer, pexif.TrailerSegment))
+        self.assertEqual(trailer.data, self.trailer)
+        self.assertEqual(jf._segments[-2].img_length, 4023)
+        self.assertEqual(jf.writeString(), data)
+
+    def test_headers_only(self):
+        # The trailer ends with an EOI marker too, which mustn't be taken
+        # as the end of the image data
+        jf = pexif.JpegFile.fromString(self.data + self.trailer,
+                                       headers_only=True)
+        self.assertEqual(jf._segments[-1].img_length, 4023)
+        self.assertEqual(jf._segments[-1].length, len(self.trailer))
+        jf.remove_metadata(paranoid=True)
+        self.assertFalse([seg for seg in jf._segments
+                          if isinstance(seg, pexif.TrailerSegment)])
+
+    def test_rewrite(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "trailer.jpg")
+            open(path, "wb").write(self.data + self.trailer)
+            jf = pexif.JpegFile.fromFile(path, headers_only=True)
+            jf.exif.primary.Make = "A longer make"
+            self.assertFalse(jf.patch_in_place(path))
+            jf = pexif.JpegFile.fromFile(path, use_mmap=True)
+            self.assertEqual(jf.exif.primary.Make, "A longer make")
+            self.assertEqual(str(jf._segments[-1].data), self.trailer)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_dump(self):
+        jf = pexif.JpegFile.fromString(self.data + self.trailer)
+        out = StringIO.StringIO()
+        jf.dump(out)
+        self.assertTrue(out.getvalue().endswith(
+            " Section: [Trail] Size:     %d\n" % len(self.trailer)))
+
+
+class TestScans(unittest.TestCase):
+
+    def test_progressive(self):
+        sos = pexif.JpegFile.fromFile(DEFAULT_TESTFILE)._segments[-1]
+        scans = sos.get_scans()
+        self.assertEqual(len(scans), 10)
+        self.assertEqual(scans[0][0], sos.img_offset)
+        offset, length = scans[-1]
+        self.assertEqual(offset + length, sos.img_offset + sos.img_length)
+
+    def test_baseline(self):
+        sos = pexif.JpegFile.fromFile(NONEXIST_TESTFILE)._segments[-1]
+        self.assertEqual(sos.get_scans(), [(sos.img_offset, sos.img_length)])
+
+    def test_headers_only(self):
+        for test_file, _ in test_data:
+            expected = pexif.JpegFile.fromFile(test_file)._segments[-1]
+            jf = pexif.JpegFile.fromFile(test_file, headers_only=True)
+            with open(test_file, "rb") as src:
+                self.assertEqual(jf._segments[-1].get_scans(src),
+                                 expected.get_scans())
+
+    def test_small_chunks(self):
+        # Markers split across chunks are still found
+        data = open(DEFAULT_TESTFILE, "rb").read()
+        expected = pexif.JpegFile.fromString(data)._segments[-1]
+        chunk_size = pexif.COPY_CHUNK_SIZE
+        for size in (1, 2, 3, 7, 64):
+            pexif.COPY_CHUNK_SIZE = size
+            try:
+                jf = pexif.JpegFile.fromString(data + "trailer\xff\xd9",
+                                               headers_only=True)
+                jf._segments[-1].get_scans()
+            finally:
+                pexif.COPY_CHUNK_SIZE = chunk_size
+            sos = jf._segments[-2]
+            self.assertEqual(sos.img_length, expected.img_length)
+            self.assertEqual(sos.scans, expected.get_scans())
+
+
+class TestParser(unittest.TestCase):
+
+    def test_dump(self):
+        # Feeding the file a byte at a time gives the same result as
+        # reading its headers
+        for test_file, expected_file in test_data:
+            parser = pexif.JpegParser()
+            for c in open(test_file, "rb").read():
+                parser.feed(c)
+            jpeg = parser.close("tmp")
+            out = StringIO.StringIO()
+            jpeg.dump(out)
+            expected = open(expected_file, "rb").read()
+            self.assertEqual(expected.split("\n", 1)[1],
+                             out.getvalue().split("\n", 1)[1])
+
+    def test_metadata_complete(self):
+        data = open(DEFAULT_TESTFILE, "rb").read()
+        parser = pexif.JpegParser()
+        parser.feed(data[:1000])
+        self.assertFalse(parser.metadata_complete)
+        self.assertEqual(parser.get_exif(), None)
+        segments = parser.feed(data[1000:7000])
+        self.assertTrue(parser.metadata_complete)
+        self.assertTrue(isinstance(segments[-1], pexif.StartOfScanSegment))
+        self.assertEqual(parser.get_exif().primary.Make, "Canon")
+        self.assertEqual(len(parser.buf), 0)
+        self.assertEqual(parser.feed(data[7000:]), [])
+
+    def test_rewrite(self):
+        data = open(DEFAULT_TESTFILE, "rb").read()
+        parser = pexif.JpegParser(mode="rw")
+        for i in range(0, len(data), 100):
+            parser.feed(data[i:i + 100])
+        jpeg = parser.close()
+        jpeg.exif.primary.Make = "Parsed"
+        expected = pexif.JpegFile.fromString(data)
+        expected.exif.primary.Make = "Parsed"
+        out = io.BytesIO()
+        jpeg.writeFd(out, io.BytesIO(data))
+        self.assertEqual(out.getvalue(), expected.writeString())
+
+    def test_trailer(self):
+        # Data after the EOI marker, which may itself end with an EOI
+        # marker, becomes a trailer however the file is split up
+        data = open(DEFAULT_TESTFILE, "rb").read()
+        trailer = "\xff\xd8 second image \xff\xd9"
+        expected = pexif.JpegFile.fromString(data + trailer)
+        expected.exif.primary.Make = "Parsed"
+        for size in (1, 3, 100, len(data) + len(trailer)):
+            parser = pexif.JpegParser(mode="rw")
+            for i in range(0, len(data + trailer), size):
+                parser.feed((data + trailer)[i:i + size])
+            jpeg = parser.close()
+            self.assertEqual(jpeg._segments[-2].img_length, 4023)
+            self.assertEqual(jpeg._segments[-1].length, len(trailer))
+            out = StringIO.StringIO()
+            jpeg.dump(out)
+            jpeg.exif.primary.Make = "Parsed"
+            out = io.BytesIO()
+            jpeg.writeFd(out, io.BytesIO(data + trailer))
+            self.assertEqual(out.getvalue(), expected.writeString())
+
+    def test_invalid(self):
+        parser = pexif.JpegParser()
+        self.assertRaises(pexif.JpegFile.InvalidFile, parser.feed, "GIF89a")
+        parser = pexif.JpegParser()
+        parser.feed(open(DEFAULT_TESTFILE, "rb").read()[:100])
+        self.assertRaises(pexif.JpegFile.InvalidFile, parser.close)
+        # The image data must end with the EOI marker
+        parser = pexif.JpegParser()
+        parser.feed(open(DEFAULT_TESTFILE, "rb").read()[:-2])
+        self.assertRaises(pexif.JpegFile.InvalidFile, parser.close)
+
+
+class TestMetadataRewriter(unittest.TestCase):
+
+    def test_run(self):
+        for test_file, _ in test_data:
+            data = open(test_file, "rb").read()
+            out = io.BytesIO()
+            edit = lambda jpeg: jpeg.set_geo(-37.312312, 45.412321)
+            rewriter = pexif.MetadataRewriter(io.BytesIO(data), out, edit,
+                                              chunk_size=1000)
+            lat, lng = rewriter.run().get_geo()
+            self.assertAlmostEqual(lat, -37.312312)
+            self.assertAlmostEqual(lng, 45.412321)
+            expected = pexif.JpegFile.fromString(data)
+            expected.set_geo(-37.312312, 45.412321)
+            self.assertEqual(out.getvalue(), expected.writeString())
+
+    def test_write(self):
+        data = open(DEFAULT_TESTFILE, "rb").read() + "trailer"
+        out = io.BytesIO()
+        edit = lambda jpeg: jpeg.remove_metadata(paranoid=False)
+        rewriter = pexif.MetadataRewriter(None, out, edit)
+        for i in range(0, len(data), 7):
+            rewriter.write(data[i:i + 7])
+        rewriter.close()
+        expected = pexif.JpegFile.fromString(data)
+        expected.remove_metadata(paranoid=False)
+        self.assertEqual(out.getvalue(), expected.writeString())
+
+    def test_truncated(self):
+        rewriter = pexif.MetadataRewriter(io.BytesIO(pexif.SOI_MARKER + "\xff\xe0"), io.BytesIO(),
+                                          lambda jpeg: None)
+        self.assertRaises(pexif.JpegFile.InvalidFile, rewriter.run)
+
+
+class TestRewrite(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_rewrite(self):
+        # Rewriting an unmodified file should give the same data
+        for test_file, _ in test_data:
+            dst = os.path.join(self.tmpdir, "out.jpg")
+            jf = pexif.JpegFile.fromFile(test_file, headers_only=True)
+            jf.rewrite(test_file, dst)
+            self.assertEqual(open(test_file, "rb").read(),
+                             open(dst, "rb").read())
+
+    def test_rewrite_in_place(self):
+        for test_file, _ in test_data:
+            path = os.path.join(self.tmpdir, "in_place.jpg")
+            shutil.copy(test_file, path)
+            jf = pexif.JpegFile.fromFile(path, headers_only=True)
+            jf.set_geo(-37.312312, 45.412321)
+            jf.rewrite(path, path)
+            expected = pexif.JpegFile.fromFile(test_file)
+            expected.set_geo(-37.312312, 45.412321)
+            self.assertEqual(expected.writeString(), open(path, "rb").read())
+            self.assertEqual(os.listdir(self.tmpdir), ["in_place.jpg"])
+
+
+class TestPatchInPlace(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "patch.jpg")
+        shutil.copy(DEFAULT_TESTFILE, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_value_offset(self):
+        jf = pexif.JpegFile.fromFile(self.path, headers_only=True)
+        primary = jf.exif.primary
+        offset = primary.value_offset(0x132)
+        data = open(self.path, "rb").read()
+        self.assertEqual(data[offset:offset + 20], primary.DateTime + "\0")
+
+    def test_patch_same_size(self):
+        jf = pexif.JpegFile.fromFile(self.path, headers_only=True)
+        jf.exif.primary.DateTime = "2007:02:15 16:36:55"
+        jf.exif.primary.ExtendedEXIF.DateTimeOriginal = "2007:02:15 16:36:55"
+        self.assertTrue(jf.patch_in_place(self.path))
+        before = open(DEFAULT_TESTFILE, "rb").read()
+        after = open(self.path, "rb").read()
+        self.assertEqual(len(before), len(after))
+        changed = [i for i in range(len(before)) if before[i] != after[i]]
+        self.assertTrue(0 < len(changed) <= 40)
+        primary = pexif.JpegFile.fromFile(self.path).exif.primary
+        self.assertEqual(primary.DateTime, "2007:02:15 16:36:55")
+        self.assertEqual(primary.ExtendedEXIF.DateTimeOriginal,
+                         "2007:02:15 16:36:55")
+
+    def test_patch_fallback(self):
+        jf = pexif.JpegFile.fromFile(self.path, headers_only=True)
+        jf.exif.primary.Make = "A longer make"
+        self.assertFalse(jf.patch_in_place(self.path))
+        jf = pexif.JpegFile.fromFile(self.path)
+        self.assertEqual(jf.exif.primary.Make, "A longer make")
+        self.assertEqual(jf.exif.primary.Model, "Canon DIGITAL IXUS II")
+
+    def test_patch_removed_ifd(self):
+        jf = pexif.JpegFile.fromFile(self.path, headers_only=True)
+        self.assertEqual(len(jf.exif.ifds), 2)
+        jf.exif.ifds.pop()
+        self.assertFalse(jf.patch_in_place(self.path))
+        jf = pexif.JpegFile.fromFile(self.path)
+        self.assertEqual(len(jf.exif.ifds), 1)
+        self.assertEqual(jf.exif.primary.Make, "Canon")
+
+
+class TestMmap(unittest.TestCase):
+
+    def test_regen(self):
+        for test_file, _ in test_data:
+            data = open(test_file, "rb").read()
+            jpeg = pexif.JpegFile.fromFile(test_file, use_mmap=True)
+            self.assertTrue(isinstance(jpeg._segments[-1].img_data, buffer))
+            self.assertEqual(data, jpeg.writeString())
+
+    def test_dump(self):
+        for test_file, expected_file in test_data:
+            for headers_only in (False, True):
+                expected = open(expected_file, 'rb').read()
+                jpeg = pexif.JpegFile.fromFile(test_file, use_mmap=True,
+                                               headers_only=headers_only)
+                out = StringIO.StringIO()
+                jpeg.dump(out)
+                self.assertEqual(expected, out.getvalue())
+
+    def test_empty_file(self):
+        tmp = tempfile.NamedTemporaryFile()
+        self.assertRaises(pexif.JpegFile.InvalidFile, pexif.JpegFile.fromFile,
+                          tmp.name, use_mmap=True)
+
+
+class TestLazy(unittest.TestCase):
+
+    def test_dump(self):
+        for test_file, expected_file in test_data:
+            expected = open(expected_file, 'rb').read()
+            jpeg = pexif.JpegFile.fromFile(test_file, lazy=True)
+            out = StringIO.StringIO()
+            jpeg.dump(out)
+            self.assertEqual(expected, out.getvalue())
+
+    def test_regen(self):
+        for test_file, _ in test_data:
+            data = open(test_file, "rb").read()
+            jpeg = pexif.JpegFile.fromString(data, lazy=True)
+            self.assertEqual(data, jpeg.writeString())
+
+    def test_decode_on_access(self):
+        jf = pexif.JpegFile.fromFile(DEFAULT_TESTFILE, lazy=True)
+        primary = jf.exif.primary
+        raw = [e for e in primary.entries
+               if isinstance(e[2], pexif.RawValue)]
+        self.assertTrue(len(raw) > 0)
+        self.assertEqual(primary.Model, "Canon DIGITAL IXUS II")
+        self.assertEqual(primary.ExtendedEXIF.DateTimeOriginal,
+                         "2006:01:14 15:35:54")
+        jf.set_geo(51.522, -1.455)
+        new = pexif.JpegFile.fromString(jf.writeString())
+        self.assertEqual(new.exif.primary.Model, "Canon DIGITAL IXUS II")
+        lat, lng = new.get_geo()
+        self.assertAlmostEqual(lat, 51.522, 6)
+        self.assertAlmostEqual(lng, -1.455, 6)
+
+
+class TestCompact(unittest.TestCase):
+
+    def test_no_instance_dict(self):
+        jf = pexif.JpegFile.fromFile(DEFAULT_TESTFILE)
+        objects = [pexif.Rational(1, 2)] + jf._segments + jf.exif.ifds + \
+                  [jf.exif.primary.ExtendedEXIF]
+        for obj in objects:
+            self.assertFalse(hasattr(obj, "__dict__"), obj)
+
+    def test_array_storage(self):
+        primary = pexif.JpegFile.fromFile(DEFAULT_TESTFILE).exif.primary
+        entry = primary.entries[primary.entry_index(0x11a)]
+        self.assertEqual(entry[2].tolist(), [180, 1])
+        self.assertEqual(primary.XResolution[0].as_tuple(), (180, 1))
+        primary.Orientation = [6]
+        self.assertEqual(primary.entries[primary.entry_index(0x112)][2].tolist(),
+                         [6])
+        self.assertEqual(primary.Orientation, [6])
+        # Changing a value changes the IFD
+        primary.Orientation.append(1)
+        self.assertEqual(primary.Orientation, [6, 1])
+        self.assertEqual(primary.entries[primary.entry_index(0x112)][2].tolist(),
+                         [6, 1])
+
+    def test_long_values_are_ints(self):
+        # Values were ints before they were stored in arrays
+        filename = "test/data/conker.jpg"
+        primary = pexif.JpegFile.fromFile(filename).exif.primary
+        self.assertEqual(repr(primary.ExtendedEXIF.PixelXDimension),
+                         "[4048]")
+        self.assertEqual(type(primary.XResolution[0].num), int)
+        tags = pexif.JpegFile.read_tags(filename, ["PixelXDimension"])
+        self.assertEqual(repr(tags["PixelXDimension"]), "[4048]")
+
+    def test_value_assigned_back(self):
+        jf = pexif.JpegFile.fromFile(DEFAULT_TESTFILE)
+        jf.set_geo(-37.5, 145.25)
+        gps = jf.exif.primary.GPS
+        gps.GPSLatitude[2] = pexif.Rational(30, 1)
+        self.assertEqual(gps.GPSLatitude[2].as_tuple(), (30, 1))
+        latitude = gps.GPSLatitude
+        latitude[1:] = [pexif.Rational(0, 1)]
+        latitude += [pexif.Rational(1, 1)]
+        jf = pexif.JpegFile.fromString(jf.writeString())
+        self.assertEqual([r.as_tuple() for r in
+                          jf.exif.primary.GPS.GPSLatitude],
+                         [(37, 1), (0, 1), (1, 1)])
+        # Values pickle as plain lists, without their IFD
+        value = pickle.loads(pickle.dumps(jf.exif.primary.Orientation))
+        self.assertEqual(type(value), list)
+        self.assertEqual(value, [jf.exif.primary.Orientation[0]])
+
+    def test_bulk_codec(self):
+        short = pexif.ExifType.lookup[pexif.SHORT]
+        self.assertEqual(short.decode(">", "\x00\x01\x01\x00").tolist(),
+                         [1, 256])
+        self.assertEqual(short.decode("<", "\x00\x01\x01\x00").tolist(),
+                         [256, 1])
+        srational = pexif.ExifType.lookup[pexif.SRATIONAL]
+        values = srational.decode(">", srational.encode(">", [-1, 3, 5, -7]))
+        self.assertEqual(values.tolist(), [-1, 3, 5, -7])
+
+    def test_get_struct(self):
+        entry = pexif.get_struct("<HHII")
+        self.assertTrue(pexif.get_struct("<HHII") is entry)
+        self.assertEqual(entry.size, 12)
+
+    def test_corrupt_count(self):
+        # A huge entry count is rejected before anything is decoded
+        data = open(DEFAULT_TESTFILE, "rb").read()
+        offset, length = pexif.find_exif(io.BytesIO(data))
+        tiff = offset + 6
+        e = "<" if data[tiff:tiff + 2] == "II" else ">"
+        ifd = tiff + struct.unpack(e + "I", data[tiff + 4:tiff + 8])[0]
+        data = data[:ifd] + struct.pack(e + "H", 0xffff) + data[ifd + 2:]
+        structs = len(pexif._structs)
+        self.assertRaises(pexif.JpegFile.InvalidFile,
+                          pexif.JpegFile.fromString, data)
+        self.assertRaises(pexif.JpegFile.InvalidFile,
+                          pexif.extract_thumbnail, io.BytesIO(data))
+        self.assertTrue(len(pexif._structs) <= structs + 1)
+
+    def test_table_structs(self):
+        # Each table is decoded in one call, and only the Structs of small
+        # tables are cached
+        jf = pexif.JpegFile.fromFile(DEFAULT_TESTFILE)
+        primary = jf.exif.primary
+        fmt = jf.exif.e + "HHII" * len(primary.entries)
+        self.assertTrue(fmt in pexif._structs)
+        max_cached = pexif.MAX_CACHED_ENTRIES
+        pexif._structs.clear()
+        pexif.MAX_CACHED_ENTRIES = 0
+        try:
+            jf = pexif.JpegFile.fromFile(DEFAULT_TESTFILE)
+            self.assertEqual(jf.exif.primary.Make, primary.Make)
+        finally:
+            pexif.MAX_CACHED_ENTRIES = max_cached
+        self.assertFalse([fmt for fmt in pexif._structs if "HHIIHHII" in fmt])
+
+    def test_big_endian(self):
+        jf = pexif.JpegFile.fromFile(NONEXIST_TESTFILE)
+        exif = jf.get_exif(create=True)
+        exif.e = ">"
+        exif.tiff_endian = "MM"
+        primary = exif.get_primary(create=True)
+        primary.XResolution = [pexif.Rational(72, 1)]
+        primary.StripOffsets = range(0, 70000, 1000)
+        primary.BitsPerSample = [8, 8, 8]
+        new = pexif.JpegFile.fromString(jf.writeString()).exif
+        self.assertEqual(new.tiff_endian, "MM")
+        self.assertEqual(new.primary.XResolution[0].as_tuple(), (72, 1))
+        self.assertEqual(new.primary.StripOffsets, range(0, 70000, 1000))
+        self.assertEqual(new.primary.BitsPerSample, [8, 8, 8])
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.paths = []
+        for i, (test_file, _) in enumerate(test_data):
+            path = os.path.join(self.tmpdir, "%d.jpg" % i)
+            shutil.copy(test_file, path)
+            self.paths.append(path)
+
+    def tearDown(self):
+        pexif.metadata_cache = None
+        shutil.rmtree(self.tmpdir)
+
+    def test_hit(self):
+        cache = pexif.MetadataCache()
+        jf = cache.load(self.paths[0])
+        self.assertTrue(cache.load(self.paths[0]) is jf)
+        self.assertFalse(cache.load(self.paths[0], headers_only=True) is jf)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertEqual(jf.mode, "ro")
+
+    def test_invalidate(self):
+        cache = pexif.MetadataCache()
+        path = self.paths[0]
+        self.assertEqual(cache.load(path).exif.primary.Make, "Canon")
+        jf = pexif.JpegFile.fromFile(path)
+        jf.exif.primary.Make = "Other make"
+        jf.writeFile(path)
+        jf = cache.load(path)
+        self.assertEqual(jf.exif.primary.Make, "Other make")
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.nbytes, cache.entry_size(jf))
+
+    def test_evict(self):
+        cache = pexif.MetadataCache(max_entries=2)
+        for path in self.paths:
+            cache.load(path)
+        self.assertEqual(len(cache), 2)
+        cache.load(self.paths[1])
+        cache.load(self.paths[0])
+        self.assertEqual(cache.misses, 4)
+        self.assertEqual([key[0] for key in cache.entries],
+                         [os.path.abspath(p) for p in self.paths[1::-1]])
+
+        size = os.path.getsize(self.paths[0])
+        cache = pexif.MetadataCache(max_bytes=size)
+        cache.load(self.paths[0])
+        cache.load(self.paths[1])
+        self.assertEqual(len(cache), 1)
+        self.assertTrue(cache.nbytes <= size)
+        cache.clear()
+        self.assertEqual((len(cache), cache.nbytes), (0, 0))
+
+    def test_from_file(self):
+        pexif.metadata_cache = pexif.MetadataCache()
+        jf = pexif.JpegFile.fromFile(self.paths[0], mode="ro")
+        self.assertTrue(pexif.JpegFile.fromFile(self.paths[0], mode="ro")
+                        is jf)
+        self.assertFalse(pexif.JpegFile.fromFile(self.paths[0]) is jf)
+        self.assertEqual(pexif.extract_fields(self.paths[0], ["Make"]),
+                         {"Make": "Canon"})
+        self.assertEqual(pexif.metadata_cache.hits, 1)
+
+
+class TestPassthrough(unittest.TestCase):
+
+    def padded(self):
+        # rose.jpg with padding after the EXIF data, which isn't kept
+        # when the segment is re-encoded
+        data = open(DEFAULT_TESTFILE, "rb").read()
+        start = data.index("\xff\xe1")
+        size = struct.unpack(">H", data[start + 2:start + 4])[0]
+        end = start + 2 + size
+        return (data[:start + 2] + struct.pack(">H", size + 16) +
+                data[start + 4:end] + "\0" * 16 + data[end:])
+
+    def test_unmodified(self):
+        data = self.padded()
+        for lazy in (False, True):
+            jf = pexif.JpegFile.fromString(data, lazy=lazy)
+            primary = jf.exif.primary
+            self.assertEqual(primary.Make, "Canon")
+            self.assertEqual(primary.ExtendedEXIF.DateTimeOriginal,
+                             "2006:01:14 15:35:54")
+            self.assertFalse(jf.exif.is_modified())
+            self.assertEqual(jf.writeString(), data)
+
+    def test_modified(self):
+        data = self.padded()
+        jf = pexif.JpegFile.fromString(data)
+        jf.exif.primary.ExtendedEXIF.DateTimeOriginal = "2007:01:14 15:35:54"
+        self.assertTrue(jf.exif.primary.is_modified())
+        self.assertFalse(jf.exif.primary.ExtendedEXIF.MakerNote.is_modified())
+        out = jf.writeString()
+        self.assertEqual(len(out), len(data) - 16)
+        jf = pexif.JpegFile.fromString(out)
+        self.assertEqual(jf.exif.primary.ExtendedEXIF.DateTimeOriginal,
+                         "2007:01:14 15:35:54")
+
+        jf = pexif.JpegFile.fromString(data)
+        del jf.exif.ifds[1]
+        self.assertTrue(jf.exif.is_modified())
+        self.assertNotEqual(jf.writeString(), data)
+
+
+class TestThumbnail(unittest.TestCase):
+
+    def test_get_thumbnail(self):
+        data = open(DEFAULT_TESTFILE, "rb").read()
+        for use_mmap in (False, True):
+            thumb = pexif.JpegFile.fromFile(DEFAULT_TESTFILE,
+                                            use_mmap=use_mmap).exif.ifds[1]
+            jpeg_data = thumb.get_thumbnail()
+            self.assertEqual(len(jpeg_data), 4811)
+            self.assertEqual(jpeg_data[:2], pexif.SOI_MARKER)
+            self.assertTrue(jpeg_data in data)
+            self.assertEqual(thumb.jpeg_data, jpeg_data)
+            out = io.BytesIO()
+            thumb.write_thumbnail(out)
+            self.assertEqual(out.getvalue(), jpeg_data)
+
+    def test_rewrite(self):
+        # The thumbnail is written out after the IFDs are changed
+        jf = pexif.JpegFile.fromFile(DEFAULT_TESTFILE)
+        expected = jf.exif.ifds[1].get_thumbnail()
+        jf.exif.primary.Make = "A longer make"
+        jf = pexif.JpegFile.fromString(jf.writeString())
+        self.assertEqual(jf.exif.ifds[1].get_thumbnail(), expected)
+
+    def test_extract_thumbnail(self):
+        for test_file, _ in test_data:
+            jf = pexif.JpegFile.fromFile(test_file)
+            if jf.get_exif() is None:
+                expected = None
+            else:
+                expected = jf.exif.ifds[1].get_thumbnail()
+            with open(test_file, "rb") as f:
+                thumbnail = pexif.extract_thumbnail(f)
+            if expected is None:
+                self.assertEqual(thumbnail, None)
+            else:
+                self.assertEqual(str(thumbnail), expected)
+
+    def test_batch_extract_thumbnails(self):
+        filenames = [f for f, _ in test_data] + ["test/data/missing.jpg"]
+        results = list(pexif_batch.batch_extract_thumbnails(filenames, 2))
+        self.assertEqual([f for f, _ in results], filenames)
+        self.assertEqual(results[0][1][:2], pexif.SOI_MARKER)
+        self.assertEqual(results[2][1], None)
+        self.assertTrue(isinstance(results[3][1], pexif_batch.BatchError))
+
+    def test_no_thumbnail(self):
+        thumb = pexif.IfdThumbnail("<", 0, None, "rw")
+        self.assertEqual(thumb.get_thumbnail(), None)
+        self.assertRaises(pexif.JpegFile.NoSection, thumb.write_thumbnail,
+                          io.BytesIO())
+
+
+class TestReadTags(unittest.TestCase):
+
+    def test_matches_parse(self):
+        for test_file, _ in test_data:
+            names = []
+            for ifd_class in (pexif.IfdTIFF, pexif.IfdExtendedEXIF,
+                              pexif.IfdGPS):
+                names += [name for name, tag in ifd_class.tag_names.items()
+                          if tag not in ifd_class.embedded_tags]
+            tags = pexif.JpegFile.read_tags(test_file, names)
+            expected = pexif.extract_fields(test_file, names)
+            self.assertEqual(sorted(tags), sorted(expected))
+            for name in names:
+                self.assertEqual(repr(tags[name]), repr(expected[name]))
+
+    def test_selected(self):
+        tags = pexif.JpegFile.read_tags(DEFAULT_TESTFILE,
+                                        ["Make", "DateTimeOriginal",
+                                         "GPSLatitude", "Foo"])
+        self.assertEqual(tags, {"Make": "Canon",
+                                "DateTimeOriginal": "2006:01:14 15:35:54",
+                                "GPSLatitude": None, "Foo": None})
+
+    def test_maker_note(self):
+        tags = pexif.JpegFile.read_tags(DEFAULT_TESTFILE, ["MakerNote"])
+        exif = pexif.JpegFile.fromFile(DEFAULT_TESTFILE).exif
+        extended = exif.primary.ExtendedEXIF
+        for tag, offset, exif_type, size in extended.value_offsets:
+            if tag == 0x927c:
+                start = pexif.TIFF_OFFSET + offset
+                self.assertEqual(tags["MakerNote"],
+                                 exif.data[start:start + size])
+                break
+        else:
+            self.fail("No maker note")
+        self.assertEqual(pexif.JpegFile.read_tags(NONEXIST_TESTFILE,
+                                                  ["MakerNote"]),
+                         {"MakerNote": None})
+        self.assertRaises(KeyError, pexif.JpegFile.read_tags,
+                          DEFAULT_TESTFILE, ["GPS"])
+
+    def test_gps(self):
+        jf = pexif.JpegFile.fromFile(DEFAULT_TESTFILE)
+        jf.set_geo(-37.5, 145.25)
+        tmp = tempfile.NamedTemporaryFile(suffix=".jpg")
+        jf.writeFd(tmp)
+        tmp.flush()
+        tags = pexif.JpegFile.read_tags(tmp.name, ["GPSLatitudeRef",
+                                                   "GPSLatitude"])
+        self.assertEqual(tags["GPSLatitudeRef"], "S")
+        self.assertEqual(repr(tags["GPSLatitude"]),
+                         repr(jf.exif.primary.GPS.GPSLatitude))
+
+    def test_find_exif(self):
+        with open(DEFAULT_TESTFILE, "rb") as f:
+            offset, length = pexif.find_exif(f)
+            f.seek(offset)
+            self.assertEqual(f.read(6), "Exif\0\0")
+        self.assertEqual(pexif.JpegFile.fromFile(DEFAULT_TESTFILE)
+                         .exif.data_offset, offset)
+        with open(NONEXIST_TESTFILE, "rb") as f:
+            self.assertEqual(pexif.find_exif(f), None)
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_extract_fields(self):
+        fields = pexif.extract_fields(DEFAULT_TESTFILE,
+                                      ["Make", "DateTimeOriginal", "Foo"])
+        self.assertEqual(fields, {"Make": "Canon",
+                                  "DateTimeOriginal": "2006:01:14 15:35:54",
+                                  "Foo": None})
+
+    def test_find_files(self):
+        self.assertEqual(list(pexif_batch.find_files(["test/data",
+                                                      "other.txt"])),
+                         [os.path.join("test/data", name) for name in
+                          ("conker.jpg", "noexif.jpg", "rose.jpg")] +
+                         ["other.txt"])
+
+    def test_batch_extract(self):
+        filenames = [f for f, _ in test_data] * 5 + ["test/data/missing.jpg"]
+        results = list(pexif_batch.batch_extract(filenames, ["Make"], workers=2))
+        self.assertEqual([f for f, _ in results], filenames)
+        self.assertEqual(results[0][1], {"Make": "Canon"})
+        self.assertEqual(results[1][1], {"Make": "FUJIFILM"})
+        self.assertEqual(results[2][1], {"Make": None})
+        self.assertTrue(isinstance(results[-1][1], pexif_batch.BatchError))
+
+
+    def test_batch_extract_damaged(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            data = open(DEFAULT_TESTFILE, "rb").read()
+            offset, length = pexif.find_exif(io.BytesIO(data))
+            filenames = []
+            # Cut off in the entry table of the primary IFD, and in the
+            # values of the Extended EXIF IFD
+            for end in (offset + 30, offset + 1000):
+                filenames.append(os.path.join(tmpdir, "%d.jpg" % end))
+                with open(filenames[-1], "wb") as f:
+                    f.write(data[:end])
+            filenames.append(DEFAULT_TESTFILE)
+            results = list(pexif_batch.batch_extract(filenames, None, workers=2))
+            self.assertEqual([f for f, _ in results], filenames)
+            self.assertTrue(isinstance(results[0][1], pexif_batch.BatchError))
+            self.assertTrue(isinstance(results[1][1], pexif_batch.BatchError))
+            self.assertEqual(results[2][1]["Make"], "Canon")
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+def _rewrite_worker(src_path, dst_path):
+    jf = pexif.JpegFile.fromFile(DEFAULT_TESTFILE, headers_only=True)
+    jf.rewrite(src_path, dst_path)
+
+
+class TestBulkEdit(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filenames = []
+        for i, (fname, _) in enumerate(test_data):
+            dst = os.path.join(self.tmpdir, "%d.jpg" % i)
+            shutil.copy(fname, dst)
+            self.filenames.append(dst)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_edit_metadata(self):
+        jf = pexif.JpegFile.fromFile(DEFAULT_TESTFILE)
+        pexif_batch.edit_metadata(jf, {"shift": datetime.timedelta(hours=-2),
+                                 "fields": {"Artist": "Bulk", "Make": None}})
+        primary = jf.exif.primary
+        self.assertEqual(primary.ExtendedEXIF.DateTimeOriginal,
+                         "2006:01:14 13:35:54")
+        self.assertEqual(primary.Artist, "Bulk")
+        self.assertEqual(primary["Make"], None)
+        self.assertRaises(KeyError, pexif_batch.edit_metadata, jf,
+                          {"fields": {"Foo": "Bar"}})
+
+    def test_edit_strip(self):
+        jf = pexif.JpegFile.fromFile(NONEXIST_TESTFILE)
+        pexif_batch.edit_metadata(jf, {"shift": datetime.timedelta(hours=1)})
+        self.assertEqual(jf.get_exif(), None)
+        jf = pexif.JpegFile.fromFile(DEFAULT_TESTFILE)
+        pexif_batch.edit_metadata(jf, {"strip": True, "geo": (-33.8, 151.2)})
+        lat, lng = jf.get_geo()
+        self.assertAlmostEqual(lat, -33.8)
+        self.assertAlmostEqual(lng, 151.2)
+        self.assertEqual(jf.exif.primary["Make"], None)
+
+    def test_batch_edit(self):
+        truncated = os.path.join(self.tmpdir, "truncated.jpg")
+        with open(truncated, "wb") as f:
+            f.write(open(DEFAULT_TESTFILE, "rb").read()[:22])
+        filenames = [truncated] + self.filenames + \
+            [os.path.join(self.tmpdir, "missing.jpg")]
+        edit = {"fields": {"Artist": "Bulk"}}
+        results = list(pexif_batch.batch_edit(filenames, edit, workers=2))
+        self.assertEqual([f for f, _ in results], filenames)
+        for fname, result in results[1:-1]:
+            self.assertEqual(result, os.path.getsize(fname))
+            self.assertEqual(pexif.extract_fields(fname, ["Artist"]),
+                             {"Artist": "Bulk"})
+        self.assertTrue(isinstance(results[0][1], pexif_batch.BatchError))
+        self.assertTrue(isinstance(results[-1][1], pexif_batch.BatchError))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ["%d.jpg" % i for i in range(len(test_data))] +
+                         ["truncated.jpg"])
+
+    def test_worker_terminated(self):
+        # A worker terminated while writing removes its temporary file.
+        # Reading from a FIFO with no writer blocks in the middle of rewrite.
+        fifo = os.path.join(self.tmpdir, "fifo")
+        os.mkfifo(fifo)
+        pool = multiprocessing.Pool(1, pexif_batch._edit_worker_init)
+        pool.apply_async(_rewrite_worker, (fifo, self.filenames[0]))
+        for i in range(500):
+            if [f for f in os.listdir(self.tmpdir) if f.endswith(".tmp")]:
+                break
+            time.sleep(0.01)
+        pool.terminate()
+        pool.join()
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ["%d.jpg" % i for i in range(len(test_data))] +
+                         ["fifo"])
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.profiler = pexif.profiler = pexif.Profiler({"family": "test"})
+
+    def tearDown(self):
+        pexif.profiler = None
+
+    def test_stages(self):
+        jf = pexif.JpegFile.fromFile(DEFAULT_TESTFILE)
+        jf.exif.primary.Artist = "Profiled"
+        data = jf.writeString()
+        stages = self.profiler.stages
+        self.assertEqual(stages["scan"][0], 1)
+        self.assertEqual(stages["scan"][2], os.path.getsize(DEFAULT_TESTFILE))
+        self.assertEqual(stages["write"][2], len(data))
+        self.assertEqual(stages["segment.ExifSegment"][0], 1)
+        self.assertEqual(stages["ifd.IfdTIFF"][0], 1)
+        self.assertEqual(stages["serialize"][0], 1)
+        self.assertTrue(stages["scan"][1] >= stages["segment.ExifSegment"][1])
+        self.profiler.reset()
+        self.assertEqual(self.profiler.stages, {})
+
+    def test_prometheus(self):
+        self.profiler.record("scan", self.profiler.clock(), 10)
+        self.profiler.labels["family"] = 'a"b'
+        lines = self.profiler.prometheus().splitlines()
+        self.assertTrue("# TYPE pexif_stage_bytes_total counter" in lines)
+        self.assertTrue('pexif_stage_calls_total{family="a\\"b",stage="scan"} 1'
+                        in lines)
+        self.assertTrue('pexif_stage_bytes_total{family="a\\"b",stage="scan"} 10'
+                        in lines)
+
+    def test_write_prometheus(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "pexif.prom")
+            self.profiler.record("scan", self.profiler.clock(), 10)
+            self.profiler.write_prometheus(path)
+            self.assertEqual(open(path).read(), self.profiler.prometheus())
+            # Readable by a collector running as another user
+            self.assertEqual(os.stat(path).st_mode & 0777, 0644)
+            self.assertEqual(os.listdir(tmpdir), ["pexif.prom"])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestBackgroundIO(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.io = pexif_batch.BackgroundIO(2)
+
+    def tearDown(self):
+        self.io.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_rewrite(self):
+        calls = []
+        result = self.io.fromFile(DEFAULT_TESTFILE,
+                                  callback=lambda *args: calls.append(args))
+        jf = result.get()
+        self.assertEqual(calls, [(jf, None)])
+        self.assertTrue(jf.headers_only)
+        jf.exif.primary.Make = "Background"
+        dst = os.path.join(self.tmpdir, "out.jpg")
+        self.io.rewrite(jf, DEFAULT_TESTFILE, dst).get()
+        jf = pexif.JpegFile.fromFile(dst)
+        self.assertEqual(jf.exif.primary.Make, "Background")
+        dst = os.path.join(self.tmpdir, "copy.jpg")
+        self.io.writeFile(jf, dst).get()
+        self.assertEqual(open(dst, "rb").read(), jf.writeString())
+
+    def test_error(self):
+        calls = []
+        result = self.io.fromFile(NONEXIST_TESTFILE + ".missing",
+                                  callback=lambda *args: calls.append(args))
+        self.assertRaises(IOError, result.get)
+        self.assertEqual(calls[0][0], None)
+        self.assertTrue(isinstance(calls[0][1], IOError))
+
+    def test_extract(self):
+        filenames = [f for f, _ in test_data]
+        calls = []
+        result = self.io.extract(iter(filenames), ["Make"], 1,
+                                 callback=lambda *args: calls.append(args))
+        self.assertEqual(result.get(), 3)
+        self.assertEqual(calls, [((filenames[0], {"Make": "Canon"}), None),
+                                 ((filenames[1], {"Make": "FUJIFILM"}), None),
+                                 ((filenames[2], {"Make": None}), None)])
+
+    def test_extract_progress(self):
+        # Results are delivered while later files are still to be read
+        consumed = []
+
+        def filenames():
+            for i in range(20):
+                consumed.append(i)
+                yield DEFAULT_TESTFILE
+        seen = []
+        self.io.extract(filenames(), ["Make"], 1,
+                        callback=lambda *args: seen.append(len(consumed)))
+        self.io.close()
+        self.assertEqual(len(seen), 20)
+        self.assertTrue(seen[0] < 20)
+
+
+class TestIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmpdir, "photos")
+        os.mkdir(self.root)
+        for test_file, _ in test_data:
+            shutil.copy(test_file, self.root)
+        open(os.path.join(self.root, "broken.jpg"), "wb").write("broken")
+        self.db = os.path.join(self.tmpdir, "index.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_update(self):
+        self.assertEqual(pexif_index.update_index(self.db, self.root, 2),
+                         (4, 0))
+        self.assertEqual(pexif_index.update_index(self.db, self.root, 2),
+                         (0, 0))
+        rose = os.path.join(self.root, "rose.jpg")
+        jf = pexif.JpegFile.fromFile(rose)
+        jf.set_geo(-37.5, 145.25)
+        jf.writeFile(rose)
+        os.unlink(os.path.join(self.root, "conker.jpg"))
+        self.assertEqual(pexif_index.update_index(self.db, self.root, 2),
+                         (1, 1))
+        self.assertEqual(pexif_index.index_record(rose),
+                         ("Canon", "Canon DIGITAL IXUS II",
+                          "2006:01:14 15:35:54", -37.5, 145.25, 205, 154))
+        self.assertEqual(pexif_index.query_index(self.db,
+                                                 bbox=(-40, 140, -30, 150)),
+                         [os.path.abspath(rose)])
+
+    def test_query(self):
+        pexif_index.update_index(self.db, self.root, 2)
+        paths = [os.path.join(os.path.abspath(self.root), name)
+                 for name in ("broken.jpg", "noexif.jpg", "conker.jpg",
+                              "rose.jpg")]
+        self.assertEqual(pexif_index.query_index(self.db), paths)
+        self.assertEqual(pexif_index.query_index(self.db, make="FUJIFILM"),
+                         paths[2:3])
+        self.assertEqual(pexif_index.query_index(self.db, start="2005",
+                                                 end="2006:01:14"), paths[3:])
+        self.assertEqual(pexif_index.query_index(self.db, end="2006:01:13"),
+                         paths[2:3])
+        self.assertEqual(pexif_index.query_index(self.db,
+                                                 bbox=(-40, 140, -30, 150)),
+                         [])
+
+    def test_damaged(self):
+        data = open(DEFAULT_TESTFILE, "rb").read()
+        with open(os.path.join(self.root, "truncated.jpg"), "wb") as f:
+            f.write(data[:22])
+        self.assertEqual(pexif_index.update_index(self.db, self.root, 2),
+                         (5, 0))
+        self.assertEqual(len(pexif_index.query_index(self.db)), 5)
+
+    def test_interrupted(self):
+        # Rows are committed in batches, so they survive an interruption
+        def interrupted(worker, filenames, args, workers):
+            for filename in filenames[:2]:
+                yield filename, worker(filename)
+            raise KeyboardInterrupt
+        batch, commit_rows = pexif_index.batch, pexif_index.INDEX_COMMIT_ROWS
+        pexif_index.batch, pexif_index.INDEX_COMMIT_ROWS = interrupted, 2
+        try:
+            self.assertRaises(KeyboardInterrupt, pexif_index.update_index,
+                              self.db, self.root, 2)
+        finally:
+            pexif_index.batch = batch
+            pexif_index.INDEX_COMMIT_ROWS = commit_rows
+        self.assertEqual(len(pexif_index.query_index(self.db)), 2)
+        self.assertEqual(pexif_index.update_index(self.db, self.root, 2),
+                         (2, 0))
+
+
 if __name__ == "__main__":
     unittest.main()